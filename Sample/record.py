@@ -2,11 +2,17 @@ from pyspin import PySpin
 
 
 import argparse
+import os
+import sys
+
+# Task profiles live in the recorder's directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tasks import load_task, DEFAULT_TASK
 
 parser = argparse.ArgumentParser(description='Process Camera Inputs.')
 
 
-parser.add_argument('--task', metavar = 'task', type = str, default = 'open-field')
+parser.add_argument('--task', metavar = 'task', type = str, default = DEFAULT_TASK)
 parser.add_argument('--fps', metavar = 'fps', type = int, default = 225)
 #parser.add_argument('--fps', metavar = 'fps', type = int, default = 225)
 parser.add_argument('--time', metavar = 'time', type = float, default = 15)
@@ -15,6 +21,12 @@ parser.add_argument('--time', metavar = 'time', type = float, default = 15)
 args = parser.parse_args()
 #print(args.accumulate(args.integers))
 
+# This sample only knows the open-field wiring, any other task is refused
+# rather than silently recording nothing
+task = load_task(args.task)
+if task['name'] != 'open-field':
+	raise RuntimeError('Sample/record.py only records open-field, use async_record.py --task ' + task['name'])
+
 
 if args.task == 'open-field':
 	overhead_serial = '20400913'
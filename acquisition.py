@@ -0,0 +1,221 @@
+import PySpin
+import argparse
+import json
+import os
+import time
+import numpy as np
+from clocksync import latch, HOST_CLOCK
+
+MODES = ('poll', 'events')
+# Used until a benchmark has been run on this machine
+DEFAULT_MODE = 'poll'
+# Results of the last benchmark, which "auto" picks the mode from
+BENCHMARK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'acquisition.json')
+BENCHMARK_SECONDS = 10
+
+
+class CapturedFrame:
+	def __init__(self, image, on_release=None):
+
+		"""
+		Copy of an image taken inside an image event callback, where the
+		image is handed back to the driver as soon as the callback returns.
+		Stands in for the PySpin image on the save queue. on_release is
+		called once, when the copy is released
+		"""
+		self.frame = image.GetNDArray().copy()
+		self.frame_id = image.GetFrameID()
+		self.on_release = on_release
+
+	def GetFrameID(self):
+		return self.frame_id
+
+	def GetNDArray(self):
+		return self.frame
+
+	def Save(self, filename):
+		# Same bytes PySpin writes for a .Raw file
+		self.frame.tofile(filename)
+
+	def Release(self):
+		self.frame = None
+		if self.on_release is not None:
+			on_release, self.on_release = self.on_release, None
+			on_release()
+
+
+class FrameEventHandler(PySpin.ImageEventHandler):
+	def __init__(self, camera, on_frame, max_frames=None):
+
+		"""
+		Image event handler, as in the ImageEvents example. The driver calls
+		OnImageEvent on its own thread for every frame, and complete frames
+		are passed to on_frame(camera, image) there, up to max_frames.
+		on_frame must copy whatever it keeps, the image is only valid
+		during the call
+		"""
+		super(FrameEventHandler, self).__init__()
+		self.camera = camera
+		self.on_frame = on_frame
+		self.max_frames = max_frames
+		self.count = 0
+		self.incomplete = 0
+
+	def OnImageEvent(self, image):
+		if image.IsIncomplete():
+			self.incomplete += 1
+			print('WARNING: img incomplete', image.GetFrameID(), 'with status',
+				  PySpin.Image_GetImageStatusDescription(image.GetImageStatus()))
+			return
+		if self.max_frames is not None and self.count >= self.max_frames:
+			return
+		self.count += 1
+		self.on_frame(self.camera, image)
+
+
+def register_handler(camera, on_frame, max_frames=None):
+	""" Registers a FrameEventHandler on a Camera. Must happen before
+	 acquisition starts so no frame is missed """
+
+	handler = FrameEventHandler(camera, on_frame, max_frames)
+	camera.cam.RegisterEventHandler(handler)
+	return handler
+
+
+def unregister_handler(camera, handler):
+	camera.cam.UnregisterEventHandler(handler)
+
+
+def _clock_offsets(cameras):
+	""" Latches every camera clock against the host clock. Returns {name:
+	 host minus camera ns}, close enough over a short benchmark """
+
+	offsets = {}
+	for camera in cameras:
+		camera_ns, host_ns, _ = latch(camera.cam)
+		offsets[camera.cam_name] = host_ns - camera_ns
+	return offsets
+
+
+def _start(cameras):
+	""" Starts the secondaries before the primary """
+
+	for camera in sorted(cameras, key = lambda camera: camera.primary):
+		camera.start_aquisition()
+
+
+def _result(latencies, frames, cpu, wall):
+	""" Summarizes a benchmark run. latencies are host receive time minus
+	 exposure start (Timestamp chunk mapped to the host clock), in ns """
+
+	latencies = np.concatenate([np.asarray(values, dtype = np.float64) for values in latencies.values()])
+	return {
+		'frames': frames,
+		'fps': frames / wall,
+		'cpu_percent': 100 * cpu / wall,
+		'cpu_us_per_frame': 1e6 * cpu / max(frames, 1),
+		'latency_median_us': float(np.median(latencies) / 1e3) if len(latencies) else None,
+		'latency_p99_us': float(np.percentile(latencies, 99) / 1e3) if len(latencies) else None,
+	}
+
+
+def benchmark_poll(cameras, seconds=BENCHMARK_SECONDS):
+	""" Grabs frames the way async_record's polling mode does: one thread
+	 going round the cameras with GetNextImage() """
+
+	latencies = {camera.cam_name: [] for camera in cameras}
+	offsets = _clock_offsets(cameras)
+	_start(cameras)
+	frames = 0
+	cpu, start = time.process_time(), time.perf_counter()
+	try:
+		while time.perf_counter() - start < seconds:
+			for camera in cameras:
+				image = camera.cam.GetNextImage(1000)
+				received = HOST_CLOCK()
+				if not image.IsIncomplete():
+					latencies[camera.cam_name].append(
+						received - image.GetChunkData().GetTimestamp() - offsets[camera.cam_name])
+					frames += 1
+				image.Release()
+	finally:
+		for camera in cameras:
+			camera.stop_aquisition()
+	return _result(latencies, frames, time.process_time() - cpu, time.perf_counter() - start)
+
+
+def benchmark_events(cameras, seconds=BENCHMARK_SECONDS):
+	""" Receives frames through image event handlers, copying each one as
+	 the recorder's event mode does """
+
+	latencies = {camera.cam_name: [] for camera in cameras}
+	offsets = _clock_offsets(cameras)
+
+	def on_frame(camera, image):
+		received = HOST_CLOCK()
+		CapturedFrame(image)
+		latencies[camera.cam_name].append(received - image.GetChunkData().GetTimestamp() - offsets[camera.cam_name])
+
+	handlers = [(camera, register_handler(camera, on_frame)) for camera in cameras]
+	try:
+		_start(cameras)
+		cpu, start = time.process_time(), time.perf_counter()
+		time.sleep(seconds)
+		cpu, wall = time.process_time() - cpu, time.perf_counter() - start
+	finally:
+		for camera in cameras:
+			camera.stop_aquisition()
+		for camera, handler in handlers:
+			unregister_handler(camera, handler)
+	return _result(latencies, sum(handler.count for _, handler in handlers), cpu, wall)
+
+
+def benchmark(cameras, seconds=BENCHMARK_SECONDS, path=BENCHMARK_FILE):
+	""" Runs both acquisition modes on the same cameras and stores the
+	 results, with the mode of lowest median latency as the best one """
+
+	results = {'poll': benchmark_poll(cameras, seconds), 'events': benchmark_events(cameras, seconds)}
+	best = min(MODES, key = lambda mode: (results[mode]['latency_median_us'] is None,
+										  results[mode]['latency_median_us'], results[mode]['cpu_percent']))
+	report = {'seconds': seconds, 'cameras': [camera.cam_name for camera in cameras], 'best': best, 'modes': results}
+	with open(path, 'w') as file:
+		json.dump(report, file, indent = 1)
+	return report
+
+
+def choose_mode(mode='auto', path=BENCHMARK_FILE):
+	""" Resolves "auto" to the best mode of the last benchmark, or the
+	 default mode if none has been run """
+
+	if mode != 'auto':
+		return mode
+	if not os.path.isfile(path):
+		print('No acquisition benchmark yet (python acquisition.py), using ' + DEFAULT_MODE)
+		return DEFAULT_MODE
+	with open(path) as file:
+		return json.load(file)['best']
+
+
+def print_benchmark(report):
+	print('%-8s %8s %8s %8s %14s %14s %14s' % ('mode', 'frames', 'fps', 'cpu %', 'cpu us/frame',
+		'median us', 'p99 us'))
+	for mode, result in report['modes'].items():
+		print('%-8s %8d %8.1f %8.1f %14.1f %14.1f %14.1f' % (mode, result['frames'], result['fps'],
+			result['cpu_percent'], result['cpu_us_per_frame'], result['latency_median_us'] or 0,
+			result['latency_p99_us'] or 0))
+	print('Best: ' + report['best'])
+
+
+if __name__ == '__main__':
+	from rig import Rig, find_configs
+
+	parser = argparse.ArgumentParser(description='Benchmarks polling against image event acquisition on the rig.')
+	parser.add_argument('--seconds', metavar = 'seconds', type = float, default = BENCHMARK_SECONDS)
+	parser.add_argument('--fps', metavar = 'fps', type = float, default = 200)
+	args = parser.parse_args()
+
+	configs = [config.with_overrides({'AcquisitionFrameRate': args.fps}) for config in find_configs()]
+	with Rig(PySpin.System.GetInstance(), configs) as rig:
+		report = benchmark(rig.init_cameras(), args.seconds)
+	print_benchmark(report)
+	print('Written to ' + BENCHMARK_FILE)
@@ -1,5 +1,16 @@
 import PySpin
-from camera import Camera
+from rig import Rig, find_configs
+from snapshot import snapshot_cameras
+from solver import check_rig
+from metadata import write_metadata, FrameLog, sequencer_dir
+from frameset import FrameSetAssembler, FRAMESETS_FILE, print_stats
+from clocksync import ClockSync
+from integrity import check_session, print_report
+from ttl import align_session, print_events
+from tasks import load_task, task_configs, save_task, session_dir, BACKENDS, DEFAULT_TASK
+from acquisition import choose_mode, register_handler, unregister_handler, CapturedFrame
+from latency import LatencyTracker, register_exposure_end, print_latency, LATENCY_FILE
+from bandwidth import host_controllers, plan_bandwidth, apply_bandwidth
 from multiprocessing import Process
 import png
 import argparse
@@ -7,37 +18,63 @@ import numpy as np
 
 import asyncio
 import os
+import threading
 from concurrent.futures import ThreadPoolExecutor
 import cv2
 
 parser = argparse.ArgumentParser(description='Process Camera Inputs.')
 
 
-parser.add_argument('--task', metavar = 'task', type = str, default = 'open-field')
-parser.add_argument('--fps', metavar = 'fps', type = int, default = 200)
-parser.add_argument('--time', metavar = 'time', type = float, default = 60*5)
+parser.add_argument('--task', metavar = 'task', type = str, default = DEFAULT_TASK,
+                    help = 'Task profile in tasks.yaml: cameras, overrides, frame rate, length and output')
+parser.add_argument('--fps', metavar = 'fps', type = int, default = None,
+                    help = 'Frame rate, defaults to the task\'s')
+parser.add_argument('--time', metavar = 'time', type = float, default = None,
+                    help = 'Seconds to record, defaults to the task\'s')
+parser.add_argument('--root', metavar = 'root', type = str, default = 'D:\\',
+                    help = 'Data directory, every recording goes in its own <task>_<date>_<time> directory in it')
 parser.add_argument('--numsavers', metavar = 'num-savers', type = int, default = 1)
+parser.add_argument('--force', action = 'store_true',
+                    help = 'Record even if the configs cannot reach --fps')
+parser.add_argument('--bandwidth', metavar = 'policy', type = str, default = 'warn', choices = ['warn', 'lower'],
+                    help = 'When the USB buses cannot carry --fps: warn, or lower the frame rate to fit')
+parser.add_argument('--userset', metavar = 'user-set', type = str, default = None,
+                    help = 'Warm start cameras from this user set, e.g. UserSet1')
+parser.add_argument('--acquisition', metavar = 'mode', type = str, default = 'auto', choices = ['auto', 'poll', 'events'],
+                    help = 'Poll with GetNextImage, receive image events, or auto: the best of the last benchmark')
 
 
 
 args = parser.parse_args()
-SAVE_DIRS = ['D:\\top', 'D:\\bottom', 'D:\\side']
+TASK = load_task(args.task)  # Rejects an unknown or malformed task before anything starts
+FPS = args.fps or TASK['fps']
+TIME = args.time or TASK['time']
+SAVE_ROOT = session_dir(args.root, TASK)  # Each camera saves to SAVE_ROOT\<camera name>
 NUM_SAVERS = args.numsavers
-NUM_IMAGES = int(args.fps * args.time)  # The number of images to capture
+NUM_IMAGES = int(FPS * TIME)  # The number of images to capture
 NUM_BUFFERS = 3000
+# Frames of a camera copied in event mode and waiting to be saved, at most.
+# Poll mode gets the same bound from the stream buffers, past it frames are
+# dropped rather than growing memory until the machine runs out
+MAX_QUEUED = NUM_BUFFERS
 print(NUM_IMAGES)
 print(NUM_SAVERS)
-async def acquire_images(queue: asyncio.Queue, cam: PySpin.Camera):
+async def acquire_images(queue: asyncio.Queue, cam: PySpin.Camera, frame_log: FrameLog,
+                         assembler: FrameSetAssembler, tracker: LatencyTracker):
     """
     A coroutine that captures `NUM_IMAGES` images from `cam` and puts them along
-    with the camera serial number as a tuple into the `queue`.
+    with the camera serial number and sequencer set as a tuple into the `queue`. The chunk data
+    of every complete image is logged to `frame_log`, the frame is added
+    to its cross-camera frame set in `assembler` and its arrival is timed
+    by `tracker`.
     """
     # Set up camera
 
     cam_id = cam.serial
     print(cam_id)
-    cam.start_aquisition()
-    cam = cam.cam
+    camera = cam
+    camera.start_aquisition()
+    cam = camera.cam
     #cam.Init()
 
     print('aquisition started')
@@ -50,68 +87,149 @@ async def acquire_images(queue: asyncio.Queue, cam: PySpin.Camera):
             img = cam.GetNextImage()
         except Exception as e:
             print(e)
+            continue
 
         frame_ID = img.GetFrameID()
         if img.IsIncomplete():
             print('WARNING: img incomplete', frame_ID,
                   'with status',
                   PySpin.Image_GetImageStatusDescription(img.GetImageStatus()))
+            img.Release()
             prev_frame_ID = frame_ID
             continue
+        tracker.received(cam_id, frame_ID)
         if frame_ID != prev_frame_ID + 1:
             print('WARNING: skipped frame', frame_ID)
         prev_frame_ID = frame_ID
-        queue.put_nowait((img, cam_id))
+        frame = frame_log.write(img)
+        assembler.add(camera.cam_name, frame_ID, frame.get('timestamp'))
+        queue.put_nowait((img, cam_id, frame.get('sequencer_set')))
 
         print('Queue size:', queue.qsize())
         print('[{}] Acquired image {}'.format(cam_id, frame_ID))
         await asyncio.sleep(0)  # This is necessary for context switches
 
-    # Clean up
-    await queue.join()  # Wait for all images to be saved before EndAcquisition
-    cam.EndAcquisition()
-    cam.DeInit()
-    del cam
+    # Wait for all images to be saved before EndAcquisition. Deinitializing
+    # and releasing the camera is left to the rig in main
+    await queue.join()
+    camera.stop_aquisition()
 
     
     
-async def save_images(queue: asyncio.Queue, save_dirs: dict, ext='.Raw'):
+def register_events(queue: asyncio.Queue, camera, frame_log: FrameLog, assembler: FrameSetAssembler,
+                    tracker: LatencyTracker):
+    """
+    Registers an image event handler on `camera` that copies each of its first
+    `NUM_IMAGES` frames on the driver thread and hands it to the loop, which
+    puts it into the `queue` and its frame set. Once `MAX_QUEUED` copies
+    are waiting to be saved, frames are dropped and counted instead.
+    Returns the handler and an event set once all of them are queued or
+    dropped.
+    """
+    done = asyncio.Event()
+    counts = {'queued': 0, 'dropped': 0}
+    slots = threading.BoundedSemaphore(MAX_QUEUED)
+
+    def settle():
+        if counts['queued'] + counts['dropped'] == NUM_IMAGES:
+            if counts['dropped']:
+                print('WARNING: [{}] dropped {} of {} frames, saving could not keep up'.format(
+                    camera.serial, counts['dropped'], NUM_IMAGES))
+            done.set()
+
+    def hand_off(frame: CapturedFrame, frame_ID, timestamp, sequencer_set):
+        # Runs on the event loop
+        assembler.add(camera.cam_name, frame_ID, timestamp)
+        queue.put_nowait((frame, camera.serial, sequencer_set))
+        counts['queued'] += 1
+        settle()
+
+    def drop(frame_ID):
+        # Runs on the event loop
+        if counts['dropped'] == 0:
+            print('WARNING: [{}] {} frames waiting to be saved, dropping frames from {} on until saving catches up'.format(
+                camera.serial, MAX_QUEUED, frame_ID))
+        counts['dropped'] += 1
+        settle()
+
+    def on_frame(camera, image):
+        # Runs on the driver's callback thread
+        if not slots.acquire(blocking=False):
+            loop.call_soon_threadsafe(drop, image.GetFrameID())
+            return
+        tracker.received(camera.serial, image.GetFrameID())
+        frame = frame_log.write(image)
+        loop.call_soon_threadsafe(hand_off, CapturedFrame(image, slots.release), frame['frame_id'],
+                                  frame.get('timestamp'), frame.get('sequencer_set'))
+
+    return register_handler(camera, on_frame, NUM_IMAGES), done
+
+
+async def wait_for_events(queue: asyncio.Queue, camera, done: asyncio.Event):
+    """
+    The event mode counterpart of `acquire_images`: waits until the handler
+    has queued all images, then for them to be saved before EndAcquisition.
+    """
+    await done.wait()
+    print('[{}] Acquired {} images'.format(camera.serial, NUM_IMAGES))
+    await queue.join()
+    camera.stop_aquisition()
+
+
+async def save_images(queue: asyncio.Queue, save_dirs: dict, tracker: LatencyTracker, backend='raw',
+                      compression=None):
     """
     A coroutine that gets images from the `queue` and saves
     them using the global Thread Pool Executor.
     The save paths per camera are determined by `save_dirs` and the file
-    extension is determined by the `ext` paramenter.
+    format by the `backend` and `compression` of the task.
     `save_dirs` is a dict where the keys are the camera serial numbers
-    and the values are the directory to save to.
-    Once the image is saved, it is implicitly released and the task
-    is marked as done in the queue.
+    and the values are the directory to save to. Frames of a camera
+    running its sequencer go to one subdirectory per sequencer set.
+    Once the image is saved, it is released and the task is marked as
+    done in the queue. Time on the queue and saving is
+    recorded in `tracker`.
     """
+    ext = BACKENDS[backend]['ext']
+    params = []
+    if backend == 'png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+    elif backend == 'tiff':
+        params = [cv2.IMWRITE_TIFF_COMPRESSION, compression]
     while True:
         # Receive image
-        image, cam_id = await queue.get()
+        image, cam_id, sequencer_set = await queue.get()
         # Create filename
         #print('image received for saving')
         frame_id = image.GetFrameID()
+        tracker.dequeued(cam_id, frame_id)
         filename = str(frame_id) + ext
         
-        print(save_dirs[cam_id])
-        filename = os.path.join(save_dirs[cam_id], filename)
+        save_dir = save_dirs[cam_id] if sequencer_set is None else sequencer_dir(save_dirs[cam_id], sequencer_set)
+        print(save_dir)
+        filename = os.path.join(save_dir, filename)
         print(filename)
         # Save the image using a pool of threads
         #print('saving file ' + filename )
-        await loop.run_in_executor(tpe, save_image, image, filename)
+        await loop.run_in_executor(tpe, save_image, image, filename, params)
+        image.Release()
+        tracker.saved(cam_id, frame_id)
         queue.task_done()
         print('[{}] Saved image {}'.format(cam_id, filename))
 
 
-def save_image(image: PySpin.Image, filename: str):
+def save_image(image: PySpin.Image, filename: str, params=None):
     """
-    Saves the given `image` under the given `filename`.
+    Saves the given `image` under the given `filename`, as raw bytes or,
+    with encoder `params`, through OpenCV.
     """
     # Notice how CPU time is minimized and I/O time is maximized
     #print(filename + ' is being saved')
     #np_img = image.GetNDArray()
-    image.Save(filename)
+    if params:
+        cv2.imwrite(filename, image.GetNDArray(), params)
+    else:
+        image.Save(filename)
     #cv2.imwrite(filename, np_img)
     #print(filename + ' saved')
 
@@ -120,77 +238,197 @@ def save_image(image: PySpin.Image, filename: str):
     
     
 async def main():
-    # Set up cam_list and queue
-    
+    global NUM_IMAGES
+
+    # Compile every camera config first so a malformed yaml is rejected
+    # before any camera is touched. The task picks the cameras and their
+    # overrides, and the frame rate is set on the cameras too
+    configs = task_configs(TASK, find_configs(), FPS)
+    feasibility = check_rig(configs, FPS)
+    if not args.force and not all(result['feasible'] for result in feasibility.values()):
+        raise RuntimeError('Configs cannot reach ' + str(FPS) + ' fps, see above (--force to record anyway)')
+
+    # Set up the rig and queue. Leaving the with block stops and releases
+    # every camera and the system instance, also on errors and Ctrl-C
     system = PySpin.System.GetInstance()
-    cam_list = system.GetCameras()
     queue = asyncio.Queue()
-
-    # Match serial numbers to save locations
-    #assert len(cam_list) <= len(SAVE_DIRS), 'More cameras than save directories'
-    #camera_sns = [cam.GetUniqueID() for cam in cam_list]
-    
-    bottom = Camera('20400910', False, system, 'bottom', 'bottom.yaml')
-    top = Camera('20400913', False, system, 'top', 'top.yaml')
-    side = Camera('20400920', True, system, 'side', 'side.yaml')
-    
-    for camera in [top, bottom, side]:
-        cam = camera.cam
-        s_node_map = cam.GetTLStreamNodeMap()
-
-        # Set stream buffer Count Mode to manual
-        stream_buffer_count_mode = PySpin.CEnumerationPtr(s_node_map.GetNode('StreamBufferCountMode'))
-        if not PySpin.IsAvailable(stream_buffer_count_mode) or not PySpin.IsWritable(stream_buffer_count_mode):
-            print('Unable to set Buffer Count Mode (node retrieval). Aborting...\n')
-            return False
-
-        stream_buffer_count_mode_manual = PySpin.CEnumEntryPtr(stream_buffer_count_mode.GetEntryByName('Manual'))
-        if not PySpin.IsAvailable(stream_buffer_count_mode_manual) or not PySpin.IsReadable(stream_buffer_count_mode_manual):
-            print('Unable to set Buffer Count Mode entry (Entry retrieval). Aborting...\n')
-            return False
-
-        stream_buffer_count_mode.SetIntValue(stream_buffer_count_mode_manual.GetValue())
-        print('Stream Buffer Count Mode set to manual...')
-
-        # Retrieve and modify Stream Buffer Count
-        buffer_count = PySpin.CIntegerPtr(s_node_map.GetNode('StreamBufferCountManual'))
-        if not PySpin.IsAvailable(buffer_count) or not PySpin.IsWritable(buffer_count):
-            print('Unable to set Buffer Count (Integer node retrieval). Aborting...\n')
-            return False
-
-        # Display Buffer Info
-        print('Default Buffer Count: %d' % buffer_count.GetValue())
-        print('Maximum Buffer Count: %d' % buffer_count.GetMax())
-
-        buffer_count.SetValue(NUM_BUFFERS)
-
-        print('Buffer count now set to: %d' % buffer_count.GetValue())
-        
-
-
-    camera_sns = [top.serial, bottom.serial,side.serial ]
-    
-    save_dir_per_cam = dict(zip(camera_sns, SAVE_DIRS))
-    
-    cam_list = [top, bottom, side]
-    # Start the acquisition and save coroutines
-    acquisition = [asyncio.gather(acquire_images(queue, cam)) for cam in cam_list]
-    savers = [asyncio.gather(save_images(queue, save_dir_per_cam)) for _ in range(NUM_SAVERS)]
-
-    # Wait for all images to be captured and saved
-    await asyncio.gather(*acquisition)
-    print('Acquisition complete.')
-
-    # Cancel the now idle savers
-    for c in savers:
-        c.cancel()
-
-    # Clean up
-    cam_list = system.GetCameras()
-    cam_list.Clear()
-    system.ReleaseInstance()
+    acquisition = []
+    savers = []
+    frame_logs = {}
+    assembler = None
+    clock_sync = None
+    handlers = {}
+    device_handlers = {}
+    tracker = None
+    fps = FPS
+    with Rig(system, configs) as rig:
+        try:
+            cam_list = rig.init_cameras(user_set = args.userset)
+
+            # Share each USB host controller's bandwidth between its cameras
+            bandwidth = plan_bandwidth(cam_list, FPS, host_controllers(system))
+            if bandwidth['fps'] < FPS:
+                print('WARNING: USB bandwidth only allows %.1f fps, lower --fps or shrink the ROI (see max height above)'
+                      % bandwidth['fps'])
+                if args.bandwidth == 'lower':
+                    for camera in cam_list:
+                        camera.cam.AcquisitionFrameRate.SetValue(bandwidth['fps'])
+                        if camera.primary:
+                            # A counter trigger sets the rate of every camera
+                            camera.arm_trigger(bandwidth['fps'])
+                    print('Frame rate lowered to %.1f fps' % bandwidth['fps'])
+            apply_bandwidth(bandwidth)
+
+            # Everything downstream works at the rate the primary was
+            # actually programmed to, which --bandwidth warn leaves above
+            # what the plan allows
+            fps = next(camera for camera in cam_list if camera.primary).trigger_rate()
+            NUM_IMAGES = int(fps * TIME)
+            print('Primary triggers at %.3f fps, capturing %d images' % (fps, NUM_IMAGES))
+
+            for camera in cam_list:
+                cam = camera.cam
+                s_node_map = cam.GetTLStreamNodeMap()
+
+                # Set stream buffer Count Mode to manual
+                stream_buffer_count_mode = PySpin.CEnumerationPtr(s_node_map.GetNode('StreamBufferCountMode'))
+                if not PySpin.IsAvailable(stream_buffer_count_mode) or not PySpin.IsWritable(stream_buffer_count_mode):
+                    print('Unable to set Buffer Count Mode (node retrieval). Aborting...\n')
+                    return False
+
+                stream_buffer_count_mode_manual = PySpin.CEnumEntryPtr(stream_buffer_count_mode.GetEntryByName('Manual'))
+                if not PySpin.IsAvailable(stream_buffer_count_mode_manual) or not PySpin.IsReadable(stream_buffer_count_mode_manual):
+                    print('Unable to set Buffer Count Mode entry (Entry retrieval). Aborting...\n')
+                    return False
+
+                stream_buffer_count_mode.SetIntValue(stream_buffer_count_mode_manual.GetValue())
+                print('Stream Buffer Count Mode set to manual...')
+
+                # Retrieve and modify Stream Buffer Count
+                buffer_count = PySpin.CIntegerPtr(s_node_map.GetNode('StreamBufferCountManual'))
+                if not PySpin.IsAvailable(buffer_count) or not PySpin.IsWritable(buffer_count):
+                    print('Unable to set Buffer Count (Integer node retrieval). Aborting...\n')
+                    return False
+
+                # Display Buffer Info
+                print('Default Buffer Count: %d' % buffer_count.GetValue())
+                print('Maximum Buffer Count: %d' % buffer_count.GetMax())
+
+                buffer_count.SetValue(NUM_BUFFERS)
+
+                print('Buffer count now set to: %d' % buffer_count.GetValue())
+
+
+
+            # Match serial numbers to save locations
+            save_dir_per_cam = {camera.serial: os.path.join(SAVE_ROOT, camera.cam_name) for camera in cam_list}
+            os.makedirs(SAVE_ROOT)
+            print('Saving to ' + SAVE_ROOT)
+            for save_dir in save_dir_per_cam.values():
+                os.makedirs(save_dir, exist_ok=True)
+            save_task(SAVE_ROOT, TASK, fps, [camera.cam_name for camera in cam_list])
+
+            # Frame geometry for raw2img and other readers, checked against
+            # the task first so a stale ROI never makes it into a recording
+            for camera in cam_list:
+                camera.check_geometry()
+                write_metadata(save_dir_per_cam[camera.serial], camera, fps)
+                # Demultiplexed sequencer sets are stacks of their own
+                for sequencer_set in range(len(camera.config.sequencer)):
+                    os.makedirs(sequencer_dir(save_dir_per_cam[camera.serial], sequencer_set), exist_ok=True)
+                    write_metadata(sequencer_dir(save_dir_per_cam[camera.serial], sequencer_set), camera,
+                                   fps / len(camera.config.sequencer))
+                frame_logs[camera.serial] = FrameLog(save_dir_per_cam[camera.serial], camera.config.chunks,
+                                                     len(camera.config.sequencer))
+
+            # Record the actual camera state next to the frames
+            snapshot_cameras(cam_list, save_dir_per_cam)
+
+            # Map every camera clock to the host clock while recording
+            clock_sync = ClockSync(cam_list)
+            clock_sync.start()
+
+            # One frame set per trigger, across all cameras, lined up on the
+            # host clock
+            assembler = FrameSetAssembler([camera.cam_name for camera in cam_list], fps,
+                                          os.path.join(SAVE_ROOT, FRAMESETS_FILE),
+                                          primary=next(camera.cam_name for camera in cam_list if camera.primary),
+                                          clock=clock_sync.host_time)
+
+            # Time every frame from exposure end to disk, per stage
+            tracker = LatencyTracker({camera.serial: camera.cam_name for camera in cam_list})
+
+            # Event handlers go in before acquisition starts so no frame is missed
+            mode = choose_mode(args.acquisition)
+            print('Acquisition mode: ' + mode)
+            for camera in cam_list:
+                if 'ExposureEnd' in camera.config.events:
+                    device_handlers[camera.serial] = (camera, register_exposure_end(camera, tracker))
+                if mode == 'events':
+                    handlers[camera.serial] = register_events(queue, camera, frame_logs[camera.serial], assembler,
+                                                              tracker)
+
+            # Stream on every secondary before the primary sends its first
+            # trigger, so no camera misses the first triggers
+            for camera in sorted(cam_list, key=lambda camera: camera.primary):
+                camera.start_aquisition()
+
+            # Start the acquisition and save coroutines
+            if mode == 'events':
+                acquisition = [asyncio.gather(wait_for_events(queue, cam, handlers[cam.serial][1]))
+                               for cam in cam_list]
+            else:
+                acquisition = [asyncio.gather(acquire_images(queue, cam, frame_logs[cam.serial], assembler, tracker))
+                               for cam in cam_list]
+            savers = [asyncio.gather(save_images(queue, save_dir_per_cam, tracker, TASK['backend'], TASK['compression']))
+                      for _ in range(NUM_SAVERS)]
+
+            # Wait for all images to be captured and saved
+            await asyncio.gather(*acquisition)
+            print('Acquisition complete.')
+        finally:
+            # Stop the coroutines and the callbacks, wait for saves in flight,
+            # then hand back the images that were never saved so
+            # EndAcquisition can run
+            for handler, _ in handlers.values():
+                handler.camera.stop_aquisition()
+                unregister_handler(handler.camera, handler)
+            handlers = {}
+            for camera, handler in device_handlers.values():
+                camera.cam.UnregisterEventHandler(handler)
+            device_handlers = {}
+            for task in acquisition + savers:
+                task.cancel()
+            await asyncio.gather(*acquisition, *savers, return_exceptions=True)
+            tpe.shutdown(wait=True)
+            while not queue.empty():
+                image = queue.get_nowait()[0]
+                image.Release()
+            for frame_log in frame_logs.values():
+                frame_log.close()
+            if assembler is not None:
+                assembler.close()
+                print_stats(assembler.stats)
+            if clock_sync is not None:
+                clock_sync.stop(save_dir_per_cam)
+            if tracker is not None:
+                print_latency(tracker.save(os.path.join(SAVE_ROOT, LATENCY_FILE)), fps)
+            cam = None  # No references may outlive the rig
+
+    # Check every secondary got one trigger per primary exposure
+    print_report(check_session(SAVE_ROOT, fps))
+    # Place the TTL edges seen on the cameras' input lines on every camera's frames
+    if any(config.ttl_lines for config in configs):
+        print_events(align_session(SAVE_ROOT, fps))
 
 # The event loop and Thread Pool Executor are global for convenience.
 loop = asyncio.get_event_loop()
 tpe = ThreadPoolExecutor(None)
-loop.run_until_complete(main())
+main_task = loop.create_task(main())
+try:
+    loop.run_until_complete(main_task)
+except KeyboardInterrupt:
+    # Cancelling main runs its cleanup, which stops and releases the cameras
+    print('Interrupted, stopping the cameras...')
+    main_task.cancel()
+    loop.run_until_complete(asyncio.gather(main_task, return_exceptions=True))
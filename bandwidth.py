@@ -0,0 +1,88 @@
+import PySpin
+import math
+from solver import solve_config, SENSOR_HEIGHT
+
+# What a single USB3 (5 Gbps) host controller sustains across all of its
+# ports, in bytes/s. Cameras on the same controller share this.
+HOST_CONTROLLER_LIMIT = 400000000
+# Margin kept on top of each camera's image data for protocol overhead
+HEADROOM = 0.05
+
+
+def host_controllers(system):
+	""" Returns {camera serial: interface id}. Spinnaker enumerates one
+	 interface per USB host controller, so cameras with the same interface
+	 id share a bus """
+
+	controllers = {}
+	interfaces = system.GetInterfaces()
+	for i in range(interfaces.GetSize()):
+		interface = interfaces.GetByIndex(i)
+		interface_id = PySpin.CStringPtr(interface.GetTLNodeMap().GetNode('InterfaceID')).GetValue()
+		cams = interface.GetCameras()
+		for j in range(cams.GetSize()):
+			node = cams.GetByIndex(j).GetTLDeviceNodeMap().GetNode('DeviceSerialNumber')
+			controllers[PySpin.CStringPtr(node).GetValue()] = interface_id
+		cams.Clear()
+		del interface
+	interfaces.Clear()
+	return controllers
+
+
+def _link_capacity(cam):
+	""" Highest throughput limit the camera accepts, capped by the speed the
+	 link actually negotiated (a camera on a USB2 port gets far less) """
+
+	capacity = cam.DeviceLinkThroughputLimit.GetMax()
+	try:
+		capacity = min(capacity, cam.DeviceLinkSpeed.GetValue())
+	except PySpin.SpinnakerException:
+		pass
+	return capacity
+
+
+def plan_bandwidth(cameras, fps, controllers, bus_limit=HOST_CONTROLLER_LIMIT, headroom=HEADROOM):
+	""" Splits each host controller's bandwidth between the cameras on it in
+	 proportion to what they need at fps, capped by each camera's link.
+	 Cameras missing from controllers are assumed to share one bus.
+	 Returns the plan: a throughput limit per camera, the frame rate every
+	 camera can sustain with it, and the rig frame rate (the lowest) """
+
+	buses = {}
+	for camera in cameras:
+		buses.setdefault(controllers.get(camera.serial, 'unknown'), []).append(camera)
+
+	plan = {'fps': fps, 'cameras': {}, 'buses': {}}
+	for bus, bus_cameras in sorted(buses.items()):
+		demands = {}
+		for camera in bus_cameras:
+			bytes_per_frame = solve_config(camera.config, fps)['bytes_per_frame']
+			demands[camera.cam_name] = (camera, bytes_per_frame, bytes_per_frame * fps * (1 + headroom))
+		total = sum(demand for _, _, demand in demands.values())
+		plan['buses'][bus] = {'demand': total, 'limit': bus_limit, 'cameras': sorted(demands)}
+
+		for cam_name, (camera, bytes_per_frame, demand) in demands.items():
+			limit = min(_link_capacity(camera.cam), bus_limit * demand / total)
+			max_fps = limit / (bytes_per_frame * (1 + headroom))
+			plan['cameras'][cam_name] = {'camera': camera, 'bus': bus, 'demand': demand,
+										 'limit': limit, 'max_fps': max_fps,
+										 # Rows that fit at the requested rate, for shrinking the ROI instead
+										 'max_height': int(camera.config.values.get('Height', SENSOR_HEIGHT) * min(1, max_fps / fps))}
+			plan['fps'] = min(plan['fps'], max_fps)
+
+	print('%-8s %-28s %10s %10s %10s %10s' % ('camera', 'bus', 'need MB/s', 'limit MB/s', 'max fps', 'max height'))
+	for cam_name, entry in sorted(plan['cameras'].items()):
+		print('%-8s %-28s %10.1f %10.1f %10.1f %10d' % (cam_name, entry['bus'], entry['demand'] / 1e6,
+			entry['limit'] / 1e6, entry['max_fps'], entry['max_height']))
+	return plan
+
+
+def apply_bandwidth(plan):
+	""" Sets every camera's DeviceLinkThroughputLimit from the plan """
+
+	for cam_name, entry in plan['cameras'].items():
+		node = entry['camera'].cam.DeviceLinkThroughputLimit
+		increment = max(node.GetInc(), 1)
+		limit = max(node.GetMin(), int(math.floor(entry['limit'] / increment) * increment))
+		node.SetValue(limit)
+		print(cam_name + ' - DeviceLinkThroughputLimit set to %.1f MB/s' % (limit / 1e6))
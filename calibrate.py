@@ -0,0 +1,133 @@
+import PySpin
+import argparse
+import cv2
+import numpy as np
+import os
+from rig import Rig, find_configs
+from roi import write_roi
+from utils import FULL_FRAME, SENSOR_WIDTH, SENSOR_HEIGHT
+from fake_camera import FakeCamera, FakeSystem
+
+NUM_FRAMES = 30
+MARGIN = 0.03
+# The arena must cover at least this fraction of the frame and its bounding
+# box at most MAX_AREA, otherwise the blob is noise or the surroundings
+MIN_AREA = 0.05
+MAX_AREA = 0.98
+
+
+def grab_burst(cam, num_frames=NUM_FRAMES):
+	""" Grabs num_frames from an initialized, free running camera and
+	 returns them as one (N, H, W) array """
+
+	cam.AcquisitionMode.SetValue(PySpin.AcquisitionMode_Continuous)
+	cam.BeginAcquisition()
+	frames = []
+	try:
+		while len(frames) < num_frames:
+			image = cam.GetNextImage(1000)
+			if not image.IsIncomplete():
+				frames.append(np.array(image.GetNDArray()))
+			image.Release()
+	finally:
+		cam.EndAcquisition()
+	return np.stack(frames)
+
+
+def median_background(frames):
+	""" Per-pixel median over the burst, which removes the animal and other
+	 moving objects from the arena """
+
+	return np.median(frames, axis = 0).astype(np.uint8)
+
+
+def detect_arena(background, margin=MARGIN):
+	""" Finds the arena in a background image. The image is thresholded with
+	 Otsu's method in both polarities (arena brighter or darker than its
+	 surroundings) and the largest blob of plausible size wins, the
+	 surroundings are ruled out as their bounding box is the whole frame. Returns the
+	 padded bounding rectangle as {x, y, width, height}, or None """
+
+	blurred = cv2.GaussianBlur(background, (0, 0), 5)
+	_, mask = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+	kernel = np.ones((15, 15), np.uint8)
+	frame_area = background.shape[0] * background.shape[1]
+
+	best = None
+	for candidate in (mask, 255 - mask):
+		candidate = cv2.morphologyEx(candidate, cv2.MORPH_OPEN, kernel)
+		candidate = cv2.morphologyEx(candidate, cv2.MORPH_CLOSE, kernel)
+		num_labels, _, stats, _ = cv2.connectedComponentsWithStats(candidate)
+		if num_labels < 2:
+			continue
+		areas = stats[1:, cv2.CC_STAT_AREA]
+		box_areas = stats[1:, cv2.CC_STAT_WIDTH] * stats[1:, cv2.CC_STAT_HEIGHT]
+		valid = (areas >= MIN_AREA * frame_area) & (box_areas <= MAX_AREA * frame_area)
+		if not valid.any():
+			continue
+		label = 1 + np.argmax(np.where(valid, areas, 0))
+		if best is None or stats[label, cv2.CC_STAT_AREA] > best[cv2.CC_STAT_AREA]:
+			best = stats[label]
+	if best is None:
+		return None
+
+	pad_x = int(margin * background.shape[1])
+	pad_y = int(margin * background.shape[0])
+	x = max(0, best[cv2.CC_STAT_LEFT] - pad_x)
+	y = max(0, best[cv2.CC_STAT_TOP] - pad_y)
+	right = min(background.shape[1], best[cv2.CC_STAT_LEFT] + best[cv2.CC_STAT_WIDTH] + pad_x)
+	bottom = min(background.shape[0], best[cv2.CC_STAT_TOP] + best[cv2.CC_STAT_HEIGHT] + pad_y)
+	return {'x': int(x), 'y': int(y), 'width': int(right - x), 'height': int(bottom - y)}
+
+
+def save_overlay(path, background, roi):
+	""" Writes the background with the proposed ROI drawn on it """
+
+	overlay = cv2.cvtColor(background, cv2.COLOR_GRAY2BGR)
+	if roi is not None:
+		cv2.rectangle(overlay, (roi['x'], roi['y']), (roi['x'] + roi['width'], roi['y'] + roi['height']), (0, 0, 255), 3)
+	cv2.imwrite(path, overlay)
+
+
+def load_frames(frame_dir, num_frames=NUM_FRAMES):
+	""" Reads up to num_frames full frame Mono8 .Raw files from a directory,
+	 spread over the whole session """
+
+	names = sorted(name for name in os.listdir(frame_dir) if name.lower().endswith('.raw'))
+	names = names[::max(1, len(names) // num_frames)][:num_frames]
+	return [np.fromfile(os.path.join(frame_dir, name), dtype = np.uint8).reshape(SENSOR_HEIGHT, SENSOR_WIDTH)
+		for name in names]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Proposes an arena ROI for every camera from a short burst of frames.')
+	parser.add_argument('--frames', metavar = 'frames', type = int, default = NUM_FRAMES)
+	parser.add_argument('--margin', metavar = 'margin', type = float, default = MARGIN,
+		help = 'Padding around the arena as a fraction of the frame')
+	parser.add_argument('--simulate', metavar = 'name=dir', type = str, nargs = '+', default = None,
+		help = 'Read each camera\'s frames from a directory of full frame .Raw files instead of the camera')
+	parser.add_argument('--output', metavar = 'output', type = str, default = 'calibration')
+	parser.add_argument('--dry-run', action = 'store_true', help = 'Only propose, leave the yaml files alone')
+	args = parser.parse_args()
+
+	# Calibrate on full frames with every camera free running
+	configs = [config.with_roi(FULL_FRAME).with_overrides({'TriggerMode': 'PySpin.TriggerMode_Off'})
+		for config in find_configs()]
+	if args.simulate is None:
+		system = PySpin.System.GetInstance()
+	else:
+		frame_dirs = dict(item.split('=', 1) for item in args.simulate)
+		configs = [config for config in configs if config.name in frame_dirs]
+		system = FakeSystem([FakeCamera(config.serial, frames = load_frames(frame_dirs[config.name], args.frames))
+			for config in configs])
+
+	os.makedirs(args.output, exist_ok = True)
+	with Rig(system, configs, triggered = False) as rig:
+		for camera in rig.init_cameras():
+			background = median_background(grab_burst(camera.cam, args.frames))
+			roi = detect_arena(background, args.margin)
+			save_overlay(os.path.join(args.output, camera.cam_name + '_arena.png'), background, roi)
+			print(camera.cam_name + ' - proposed ROI: ' + str(roi))
+			if roi is not None and not args.dry_run:
+				write_roi(camera.config.yaml_path, roi)
+				print(camera.cam_name + ' - written to ' + camera.config.yaml_path)
@@ -1,40 +1,152 @@
 
 from multiprocessing import Queue
+from concurrent.futures import ThreadPoolExecutor
 from utils import *
 
 import os
+import time
 import numpy as np
 import png
 
+# Trigger wiring, applied through the same diff-based applier as the yaml
+# configs so re-arming an armed camera only writes what changed, e.g. a new
+# counter rate, and leaves its trigger on (see CameraConfig.plan). The primary's
+# Line1 drives the secondaries' Line3, pulled up by the 3.3 V rail on Line2
+PRIMARY_TRIGGER = CameraConfig('<primary trigger>', {'init': [
+	{'TriggerMode': {'value': 'PySpin.TriggerMode_Off'}},
+	{'LineSelector': {'value': 'PySpin.LineSelector_Line1'}},
+	{'LineSource': {'value': 'PySpin.LineSource_ExposureActive'}},
+	{'LineSelector': {'value': 'PySpin.LineSelector_Line2'}},
+	{'V3_3Enable': {'value': True}},
+]}, None)
+SECONDARY_TRIGGER = CameraConfig('<secondary trigger>', {'init': [
+	{'TriggerMode': {'value': 'PySpin.TriggerMode_Off'}},
+	{'TriggerSource': {'value': 'PySpin.TriggerSource_Line3'}},
+	{'TriggerOverlap': {'value': 'PySpin.TriggerOverlap_ReadOut'}},
+	{'TriggerMode': {'value': 'PySpin.TriggerMode_On'}},
+]}, None)
+# Shortest delay the primary's trigger accepts, in us
+MIN_TRIGGER_DELAY_US = 9
+
+
+def counter_trigger(fps, duty_cycle=0.5, phase=0.0):
+	""" Returns the primary's trigger wiring for a fixed rate pulse train, as
+	 in the CounterAndTimer example: Counter0 counts the 1 MHz tick and runs
+	 for as long as acquisition is active, its output drives Line1, and the
+	 primary triggers itself on the start of every pulse. Secondaries are
+	 then triggered at a rate that does not depend on the primary's
+	 exposure. The period is rounded to whole us """
+
+	period_us = int(round(1e6 / fps))
+	duration_us = min(max(int(round(period_us * duty_cycle)), 1), period_us - 1)
+	return CameraConfig('<counter trigger>', {'init': [
+		{'TriggerMode': {'value': 'PySpin.TriggerMode_Off'}},
+		{'CounterSelector': {'value': 'PySpin.CounterSelector_Counter0'}},
+		{'CounterEventSource': {'value': 'PySpin.CounterEventSource_MHzTick'}},
+		{'CounterDuration': {'value': duration_us}},
+		{'CounterDelay': {'value': period_us - duration_us}},
+		{'CounterTriggerSource': {'value': 'PySpin.CounterTriggerSource_AcquisitionActive'}},
+		{'CounterTriggerActivation': {'value': 'PySpin.CounterTriggerActivation_LevelHigh'}},
+		{'LineSelector': {'value': 'PySpin.LineSelector_Line1'}},
+		{'LineSource': {'value': 'PySpin.LineSource_Counter0Active'}},
+		{'LineSelector': {'value': 'PySpin.LineSelector_Line2'}},
+		{'V3_3Enable': {'value': True}},
+		{'TriggerSource': {'value': 'PySpin.TriggerSource_Counter0Start'}},
+		{'TriggerOverlap': {'value': 'PySpin.TriggerOverlap_ReadOut'}},
+		{'TriggerDelay': {'value': max(phase * period_us, MIN_TRIGGER_DELAY_US)}},
+		{'TriggerMode': {'value': 'PySpin.TriggerMode_On'}},
+	]}, None)
+
 
 class Camera:
-	def __init__(self, serial: str, primary: bool, system, cam_name: str,\
-		yaml_path: str):
+	def __init__(self, cam, yaml_path, arm: bool = True, user_set: str = None):
 
 		"""
-		Initializes Camera
+		Initializes Camera from a PySpin camera and a path to its yaml file
+		or a compiled CameraConfig, which also gives the camera's serial,
+		name and role. With arm=False the trigger is left for a later
+		arm_trigger() call. With user_set the config is persisted to and
+		loaded from that camera user set (see utils.warm_start)
 		"""
+		config = yaml_path if isinstance(yaml_path, CameraConfig) else load_config(yaml_path)
 		self.stream_buffer = Queue()
-		self.serial = serial
-		self.primary = primary
-		cam_list = system.GetCameras()
-		self.cam = cam_list.GetBySerial(serial)
-		self.cam_name = cam_name
-		setup_cam(self.cam, yaml_path)
-		print(cam_name + ' initialized!')
-		if primary:
-			self.cam.LineSelector.SetValue(PySpin.LineSelector_Line2)
-			self.cam.V3_3Enable.SetValue(True)
-		else:
-			self.cam.TriggerMode.SetValue(PySpin.TriggerMode_Off)
-			self.cam.TriggerSource.SetValue(PySpin.TriggerSource_Line3)
-			self.cam.TriggerOverlap.SetValue(PySpin.TriggerOverlap_ReadOut)
-			self.cam.TriggerMode.SetValue(PySpin.TriggerMode_On)
-		
+		self.serial = config.serial
+		self.primary = config.primary
+		self.timings = {}
+		self.cam = cam
+		self.cam_name = config.name
+		self.config = setup_cam(self.cam, config, timings = self.timings, user_set = user_set)
+		print(self.cam_name + ' initialized!')
 		self.img_num = 0
-		print(cam_name + ' Trigger mode set!')
+		if arm:
+			self.arm_trigger()
+
+	def arm_trigger(self, fps=None):
+		""" Sets the primary up to drive Line1 and the secondaries to
+		 trigger off Line3. With a counter trigger the pulse train runs at
+		 fps, by default the config's AcquisitionFrameRate. A camera with a
+		 "sequencer" section has its sequencer programmed and started here """
+
+		start = time.perf_counter()
+		if not self.primary:
+			trigger_config = SECONDARY_TRIGGER
+		elif self.config.trigger['source'] == 'counter':
+			fps = fps or self.config.values.get('AcquisitionFrameRate')
+			if fps is None:
+				raise RuntimeError(self.cam_name + ' needs an AcquisitionFrameRate for its counter trigger')
+			trigger_config = counter_trigger(fps, self.config.trigger['duty_cycle'], self.config.trigger['phase'])
+			if abs(1e6 / round(1e6 / fps) - fps) > 1e-3:
+				print('WARNING: ' + self.cam_name + ' counter trigger runs at %.3f fps' % (1e6 / round(1e6 / fps)))
+		else:
+			trigger_config = PRIMARY_TRIGGER
+		if self.config.sequencer_config is not None:
+			SEQUENCER_OFF.apply(self.cam)
+		trigger_config.apply(self.cam)
+		if self.config.sequencer_config is not None:
+			# Last, as the running sequencer locks the nodes it switches.
+			# Always written in full, reading the sets back needs config mode
+			self.config.sequencer_config.apply(self.cam, diff = False)
+			# As in the Sequencer example, only a set chain the camera accepts
+			# is started, an invalid one would fail at acquisition start
+			if self.cam.SequencerConfigurationValid.GetValue() != PySpin.SequencerConfigurationValid_Yes:
+				raise RuntimeError(self.cam_name + ' rejected its sequencer sets (SequencerConfigurationValid is not '
+								   'Yes), check the "sequencer" section of ' + self.config.yaml_path)
+			SEQUENCER_ON.apply(self.cam, diff = False)
+			print(self.cam_name + ' sequencer started with %d sets' % len(self.config.sequencer))
+		self.timings['arm'] = time.perf_counter() - start
+		print(self.cam_name + ' Trigger mode set!')
+
+	def trigger_rate(self):
+		""" Reads back the rate an armed primary triggers the rig at: the
+		 period programmed into Counter0 for a counter trigger, otherwise
+		 the frame rate the camera reports it runs at (its
+		 AcquisitionFrameRate, unless the exposure is too long for it) """
+
+		if not self.primary:
+			raise RuntimeError(self.cam_name + ' is not the primary, it does not set the trigger rate')
+		if self.config.trigger['source'] == 'counter':
+			self.cam.CounterSelector.SetValue(PySpin.CounterSelector_Counter0)
+			return 1e6 / (self.cam.CounterDuration.GetValue() + self.cam.CounterDelay.GetValue())
+		return self.cam.AcquisitionResultingFrameRate.GetValue()
 		
+	def check_geometry(self):
+		""" Reads the frame geometry back and raises if it is not the one
+		 the config asks for, e.g. an ROI left on the camera by another task """
+
+		actual = {node: getattr(self.cam, node).GetValue() for node in ('OffsetX', 'OffsetY', 'Width', 'Height')}
+		if actual != self.config.frame_nodes():
+			raise RuntimeError(self.cam_name + ' frames are ' + str(actual) + ', its config asks for ' +
+							   str(self.config.frame_nodes()))
+
 	def start_aquisition(self):
+		""" Starts continuous acquisition, does nothing if the camera is
+		 already streaming """
+
+		if self.cam is None:
+			raise RuntimeError(self.cam_name + ' has been released')
+		if self.cam.IsStreaming():
+			return True
+
 		nodemap = self.cam.GetNodeMap()
 		node_acquisition_mode = PySpin.CEnumerationPtr(nodemap.GetNode('AcquisitionMode'))
 		if not PySpin.IsAvailable(node_acquisition_mode) or not PySpin.IsWritable(node_acquisition_mode):
@@ -56,7 +168,69 @@ class Camera:
 		print('Acquisition mode set to continuous...')
 		self.cam.BeginAcquisition()
 		print('Aquisition has begun for ' + self.cam_name)
+		return True
+
+	def stop_aquisition(self):
+		""" Ends acquisition, which hands the stream buffers back to the
+		 driver. Safe to call when the camera is not streaming or has been
+		 released. Images still held must be released before this """
+
+		if self.cam is not None and self.cam.IsStreaming():
+			self.cam.EndAcquisition()
+			print('Aquisition has ended for ' + self.cam_name)
+
+	def release(self):
+		""" Stops acquisition, deinitializes the camera and drops the
+		 reference to it, so the system instance can be released. Idempotent,
+		 and the camera is always deinitialized even if stopping fails """
+
+		if self.cam is None:
+			return
+		try:
+			self.stop_aquisition()
+		finally:
+			try:
+				if self.cam.IsInitialized():
+					self.cam.DeInit()
+			finally:
+				self.cam = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.release()
+		return False
+
+
+def init_cameras(specs, user_set=None, arm=True):
+	""" Initializes and configures every camera in specs, a list of
+	 (PySpin camera, yaml_path), with one worker per camera. Triggers are
+	 only armed once every camera is configured, secondaries first, and not
+	 at all with arm=False. Returns the cameras in the order of specs """
+
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers = len(specs)) as executor:
+		futures = [executor.submit(Camera, cam, yaml_path, False, user_set)
+			for cam, yaml_path in specs]
+	# Barrier: leaving the pool waits for every camera. If any failed, the
+	# ones that did come up are released before re-raising the first error
+	errors = [future.exception() for future in futures if future.exception() is not None]
+	if errors:
+		for future in futures:
+			if future.exception() is None:
+				future.result().release()
+		raise errors[0]
+	cameras = [future.result() for future in futures]
+	configured = time.perf_counter() - start
+
+	if arm:
+		for camera in sorted(cameras, key = lambda camera: camera.primary):
+			camera.arm_trigger()
 
-			#image_converted.Save(filename)
-			#png.from_array(image_converted).save(filename)
-			
\ No newline at end of file
+	print('Camera startup (s):')
+	for camera in cameras:
+		print('  ' + camera.cam_name + ': ' + ', '.join(
+			'%s %.3f' % (step, seconds) for step, seconds in camera.timings.items()))
+	print('  configured in %.3f, total %.3f' % (configured, time.perf_counter() - start))
+	return cameras
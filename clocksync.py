@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import threading
+import time
+import numpy as np
+from metadata import read_frames
+
+CLOCK_FILE = 'clock.json'
+# Host clock every camera clock is mapped to. perf_counter is monotonic and,
+# unlike monotonic() on Windows, has sub-microsecond resolution
+HOST_CLOCK = time.perf_counter_ns
+HOST_CLOCK_NAME = 'perf_counter_ns'
+# Seconds between latches of the same camera. Each latch is one command and
+# one read, well under a millisecond of camera traffic
+INTERVAL = 1.0
+# Samples with a round trip above this percentile are left out of the fit
+MAX_RTT_PERCENTILE = 75
+
+
+def latch(cam):
+	""" Latches the camera clock and reads it, bracketed by host clock reads.
+	 Returns (camera ns, host ns at the midpoint, round trip ns) """
+
+	before = HOST_CLOCK()
+	cam.TimestampLatch.Execute()
+	after = HOST_CLOCK()
+	return cam.TimestampLatchValue.GetValue(), (before + after) // 2, after - before
+
+
+def fit_clock(samples):
+	""" Fits host = host_ref + slope * (camera - camera_ref) to latch samples
+	 by least squares, leaving out the slowest round trips (the latch may
+	 have happened anywhere within them). The slope absorbs the drift between
+	 the two clocks """
+
+	samples = np.asarray(samples, dtype = np.int64)
+	if len(samples) < 2:
+		raise RuntimeError('At least 2 clock samples are needed, got ' + str(len(samples)))
+	if len(samples) >= 8:
+		samples = samples[samples[:, 2] <= np.percentile(samples[:, 2], MAX_RTT_PERCENTILE)]
+	camera_ref, host_ref = int(samples[0, 0]), int(samples[0, 1])
+	camera = (samples[:, 0] - camera_ref).astype(np.float64)
+	host = (samples[:, 1] - host_ref).astype(np.float64)
+	slope, intercept = np.polyfit(camera, host, 1)
+	residuals = host - (slope * camera + intercept)
+	return {
+		'host_clock': HOST_CLOCK_NAME,
+		'camera_ref': camera_ref,
+		'host_ref': host_ref + int(round(intercept)),
+		'slope': float(slope),
+		'drift_ppm': (float(slope) - 1) * 1e6,
+		'residual_ns': float(np.std(residuals)),
+		'max_rtt_ns': int(samples[:, 2].max()),
+		'samples': len(samples),
+	}
+
+
+def latch_fit(sample):
+	""" Fit from a single latch sample, assuming no drift """
+
+	return {'camera_ref': int(sample[0]), 'host_ref': int(sample[1]), 'slope': 1.0}
+
+
+def to_host(timestamps, fit):
+	""" Converts camera timestamps (ns, any array shape) to host clock ns """
+
+	offsets = np.asarray(timestamps, dtype = np.int64) - fit['camera_ref']
+	return fit['host_ref'] + np.round(offsets * fit['slope']).astype(np.int64)
+
+
+def save_clock(save_dir, fit, samples):
+	with open(os.path.join(save_dir, CLOCK_FILE), 'w') as file:
+		json.dump(dict(fit, raw_samples = [list(map(int, sample)) for sample in samples]), file, indent = 1)
+
+
+def load_clock(frame_dir):
+	""" Returns the clock fit stored next to a camera's frames, or None """
+
+	path = os.path.join(frame_dir, CLOCK_FILE)
+	if not os.path.isfile(path):
+		return None
+	with open(path) as file:
+		return json.load(file)
+
+
+def host_timestamps(frame_dir):
+	""" Returns the frame ids and host clock timestamps of every frame in a
+	 camera's frames.csv, using the stored clock fit """
+
+	frames = read_frames(frame_dir)
+	fit = load_clock(frame_dir)
+	if frames is None or fit is None:
+		raise RuntimeError('"' + frame_dir + '" needs both frames.csv and ' + CLOCK_FILE)
+	return frames['frame_id'], to_host(frames['timestamp'], fit)
+
+
+class ClockSync:
+	def __init__(self, cameras, interval=INTERVAL):
+
+		"""
+		Latches the clock of every camera against the host clock every
+		interval seconds on a background thread while recording. Cameras
+		are sampled in turn, spread over the interval, so no two latches
+		compete for the bus at once
+		"""
+		self.cameras = list(cameras)
+		self.interval = interval
+		self.samples = {camera.cam_name: [] for camera in self.cameras}
+		# Latest fit of each camera and the number of samples it was made from
+		self.fits = {}
+		self.stop_event = threading.Event()
+		self.thread = threading.Thread(target = self._run, name = 'clocksync', daemon = True)
+
+	def _run(self):
+		step = self.interval / len(self.cameras)
+		while True:
+			for camera in self.cameras:
+				if self.stop_event.wait(step):
+					return
+				try:
+					self.samples[camera.cam_name].append(latch(camera.cam))
+				except Exception as e:
+					print('WARNING: clock latch failed for ' + camera.cam_name + ': ' + str(e))
+
+	def start(self):
+		self.sample_all()
+		self.thread.start()
+
+	def sample_all(self):
+		""" Latches every camera once, right now """
+
+		for camera in self.cameras:
+			self.samples[camera.cam_name].append(latch(camera.cam))
+
+	def host_time(self, cam_name, timestamp):
+		""" Maps a camera timestamp (ns) to the host clock with the samples
+		 taken so far, refitting when new ones came in. Returns None before
+		 the camera's first sample """
+
+		samples = self.samples[cam_name]
+		num_samples = len(samples)
+		if num_samples == 0:
+			return None
+		if self.fits.get(cam_name, (0, None))[0] != num_samples:
+			fit = fit_clock(samples[:num_samples]) if num_samples >= 2 else latch_fit(samples[0])
+			self.fits[cam_name] = (num_samples, fit)
+		return int(to_host(timestamp, self.fits[cam_name][1]))
+
+	def stop(self, save_dirs=None):
+		""" Stops sampling, takes a last sample of every camera so the fit
+		 spans the whole recording, and fits each camera's clock. With
+		 save_dirs ({serial: directory}) the fits are stored next to the
+		 frames. Returns {camera name: fit} """
+
+		if self.thread.is_alive():
+			self.stop_event.set()
+			self.thread.join()
+			self.sample_all()
+		fits = {}
+		for camera in self.cameras:
+			samples = self.samples[camera.cam_name]
+			if len(samples) < 2:
+				print('WARNING: not enough clock samples for ' + camera.cam_name)
+				continue
+			fits[camera.cam_name] = fit_clock(samples)
+			if save_dirs is not None:
+				save_clock(save_dirs[camera.serial], fits[camera.cam_name], samples)
+			print(camera.cam_name + ' - clock drift %.2f ppm, residual %.1f us over %d samples' % (
+				fits[camera.cam_name]['drift_ppm'], fits[camera.cam_name]['residual_ns'] / 1e3,
+				fits[camera.cam_name]['samples']))
+		return fits
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Converts a camera\'s frame timestamps to host clock time.')
+	parser.add_argument('frame_dir', type = str, help = 'Camera directory with frames.csv and ' + CLOCK_FILE)
+	parser.add_argument('--output', metavar = 'output', type = str, default = None,
+		help = 'csv of frame id and host time (ns), defaults to host_times.csv in frame_dir')
+	args = parser.parse_args()
+
+	frame_ids, host_times = host_timestamps(args.frame_dir)
+	output = args.output or os.path.join(args.frame_dir, 'host_times.csv')
+	np.savetxt(output, np.column_stack([frame_ids, host_times]), fmt = '%d', delimiter = ',',
+		header = 'frame_id,host_time', comments = '')
+	print('%d frames written to %s' % (len(frame_ids), output))
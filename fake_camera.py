@@ -0,0 +1,403 @@
+import copy
+import threading
+import time
+from scopes import SELECTORS
+
+
+class FakeNode:
+	def __init__(self, cam, name: str):
+
+		"""
+		A single camera node backed by the fake camera's state
+		"""
+		self.cam = cam
+		self.name = name
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		return FakeNode(self.cam, self.name + '.' + name)
+
+	def _key(self):
+		selector = SELECTORS.get(self.name)
+		if selector is None:
+			return self.name
+		return (self.name, self.cam.state.get(selector))
+
+	def GetValue(self):
+		self.cam.reads.append(self.name)
+		if self._key() not in self.cam.state:
+			raise RuntimeError('Node "' + self.name + '" has not been set on the fake camera')
+		return self.cam.state[self._key()]
+
+	def SetValue(self, value):
+		self.cam.writes.append((self.name, value))
+		self.cam.state[self._key()] = value
+
+	def Execute(self):
+		self.cam.writes.append((self.name, None))
+		command = self.cam.commands.get(self.name)
+		if command is not None:
+			command()
+
+
+class FakeChunkData:
+	def __init__(self, values: dict):
+
+		"""
+		Stand-in for PySpin.ChunkData, Get<name>() returns values[name]
+		"""
+		self.values = values
+
+	def __getattr__(self, name):
+		if not name.startswith('Get') or name[3:] not in self.values:
+			raise AttributeError(name)
+		return lambda: self.values[name[3:]]
+
+
+class FakeImage:
+	def __init__(self, frame, frame_id: int, chunk_data: dict = None):
+
+		"""
+		Stand-in for a PySpin.ImagePtr holding a numpy frame
+		"""
+		self.frame = frame
+		self.frame_id = frame_id
+		self.chunk_data = FakeChunkData(chunk_data or {})
+
+	def GetNDArray(self):
+		return self.frame
+
+	def GetFrameID(self):
+		return self.frame_id
+
+	def GetChunkData(self):
+		return self.chunk_data
+
+	def IsIncomplete(self):
+		return False
+
+	def GetWidth(self):
+		return self.frame.shape[1]
+
+	def GetHeight(self):
+		return self.frame.shape[0]
+
+	def Release(self):
+		pass
+
+
+class FakeCameraList:
+	def __init__(self, cams):
+
+		"""
+		Stand-in for PySpin.CameraList
+		"""
+		self.cams = list(cams)
+
+	def GetSize(self):
+		return len(self.cams)
+
+	def GetByIndex(self, i):
+		return self.cams[i]
+
+	def GetBySerial(self, serial):
+		for cam in self.cams:
+			if cam.serial == serial:
+				return cam
+		raise RuntimeError('No fake camera with serial ' + serial)
+
+	def Clear(self):
+		self.cams = []
+
+
+class FakeSystem:
+	def __init__(self, cams):
+
+		"""
+		Stand-in for PySpin.System holding a fixed set of fake cameras
+		"""
+		self.cams = list(cams)
+
+	def GetCameras(self):
+		return FakeCameraList(self.cams)
+
+	def ReleaseInstance(self):
+		pass
+
+
+class FakeCamera:
+	def __init__(self, serial: str, state: dict = None, frames=None, realtime: bool = False):
+
+		"""
+		Stand-in for a PySpin camera, for running the config code without
+		hardware. Any attribute is a node holding a value, every read and
+		write is logged. UserSetSave/UserSetLoad copy the node state to and
+		from the user set chosen with UserSetSelector, and UserSetDefault is
+		loaded on Init() like on power up. While acquiring, GetNextImage()
+		returns the numpy arrays from frames in turn, cycling through them,
+		timestamped at AcquisitionFrameRate on the camera clock. With
+		realtime it also waits for each frame's time, and registered image
+		event handlers are called from a driver thread at that rate. Device
+		event handlers get EventExposureEnd for every frame, and the line
+		status chunk holds line_status
+		"""
+		self.serial = serial
+		self.frames = list(frames or [])
+		self.next_frame = 0
+		self.acquiring = False
+		self.realtime = realtime
+		self.handlers = []
+		self.device_handlers = []
+		self.delivery = None
+		self.state = dict(state or {})
+		self.state['TLDevice.DeviceSerialNumber'] = serial
+		self.user_sets = {}
+		self.reads = []
+		self.writes = []
+		self.initialized = False
+		# The camera clock counts ns from construction, running drift_ppm fast
+		self.clock_origin = time.perf_counter_ns()
+		self.drift_ppm = 0
+		# Input line states (bit per line) reported in the line status chunk,
+		# change it to simulate TTL input
+		self.line_status = 0
+		# Sets saved with SequencerSetSave, by SequencerSetSelector
+		self.sequencer_sets = {}
+		self.commands = {
+			'UserSetSave': self._save_user_set,
+			'UserSetLoad': self._load_user_set,
+			'TimestampLatch': self._latch_timestamp,
+			'SequencerSetSave': self._save_sequencer_set,
+		}
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		return FakeNode(self, name)
+
+	def GetUniqueID(self):
+		return self.serial
+
+	def Init(self):
+		default = self.state.get('UserSetDefault')
+		if not self.initialized and default in self.user_sets:
+			self._restore(default)
+		self.initialized = True
+
+	def DeInit(self):
+		self.initialized = False
+
+	def IsInitialized(self):
+		return self.initialized
+
+	def BeginAcquisition(self):
+		if not self.initialized:
+			raise RuntimeError('Fake camera ' + self.serial + ' is not initialized')
+		self.acquiring = True
+		self._latch_timestamp()
+		self.acquisition_start = (self.state['TimestampLatchValue'], self.next_frame)
+		if self.handlers:
+			self.delivery = threading.Thread(target = self._deliver, daemon = True)
+			self.delivery.start()
+
+	def EndAcquisition(self):
+		self.acquiring = False
+		if self.delivery is not None:
+			self.delivery.join()
+			self.delivery = None
+
+	def RegisterEventHandler(self, handler, event_name=None):
+		if hasattr(handler, 'OnDeviceEvent'):
+			self.device_handlers.append(handler)
+		else:
+			self.handlers.append(handler)
+
+	def UnregisterEventHandler(self, handler):
+		if handler in self.device_handlers:
+			self.device_handlers.remove(handler)
+		else:
+			self.handlers.remove(handler)
+
+	def _deliver(self):
+		while self.acquiring:
+			image = self._next_image(True)
+			if image is not None:
+				for handler in list(self.handlers):
+					handler.OnImageEvent(image)
+
+	def IsStreaming(self):
+		return self.acquiring
+
+	def GetNextImage(self, timeout=None):
+		if not self.acquiring:
+			raise RuntimeError('Fake camera ' + self.serial + ' is not acquiring')
+		return self._next_image(self.realtime)
+
+	def _next_image(self, wait):
+		if not self.frames:
+			raise RuntimeError('Fake camera ' + self.serial + ' has no frames')
+		frame_id = self.next_frame
+		chunk_data = self._chunk_data(frame_id)
+		if wait:
+			due = self.clock_origin + chunk_data['Timestamp'] / (1 + self.drift_ppm * 1e-6)
+			delay = (due - time.perf_counter_ns()) / 1e9
+			if delay > 0:
+				time.sleep(delay)
+			if not self.acquiring:
+				return None
+		self.next_frame += 1
+		self.state['EventExposureEndFrameID'] = frame_id
+		for handler in list(self.device_handlers):
+			handler.OnDeviceEvent('EventExposureEnd')
+		return FakeImage(self.frames[frame_id % len(self.frames)], frame_id, chunk_data)
+
+	def _chunk_data(self, frame_id):
+		""" Chunk values of a frame: timestamps tick at the configured frame
+		 rate from the start of acquisition, exposure and gain are the
+		 current node values """
+
+		fps = self.state.get('AcquisitionFrameRate') or 200
+		start_timestamp, start_frame = self.acquisition_start
+		return {
+			'Timestamp': start_timestamp + int((frame_id - start_frame) * 1e9 / fps),
+			'FrameID': frame_id,
+			'ExposureTime': self.state.get('ExposureTime', 0.0),
+			'Gain': self.state.get(('Gain', self.state.get('GainSelector')), 0.0),
+			'ExposureEndLineStatusAll': self.line_status,
+			'SequencerSetActive': self._sequencer_set(frame_id - start_frame),
+		}
+
+	def _save_sequencer_set(self):
+		selector = self.state.get('SequencerSetSelector')
+		self.sequencer_sets[selector] = {'ExposureTime': self.state.get('ExposureTime'),
+			'next': self.state.get(('SequencerSetNext', selector))}
+		# Valid once every saved set leads to a saved set. Only the config
+		# code saves sets, which has PySpin
+		import PySpin
+		valid = all(sequencer_set['next'] in self.sequencer_sets for sequencer_set in self.sequencer_sets.values())
+		self.state['SequencerConfigurationValid'] = (PySpin.SequencerConfigurationValid_Yes if valid
+			else PySpin.SequencerConfigurationValid_No)
+
+	def _sequencer_set(self, frame):
+		""" Set the n-th frame of the acquisition is exposed with, following
+		 each set's SequencerSetNext from set 0 while the sequencer is on """
+
+		if 0 not in self.sequencer_sets:
+			return 0
+		# Only sets saved through the config code get here, which has PySpin
+		import PySpin
+		if self.state.get('SequencerMode') != PySpin.SequencerMode_On:
+			return 0
+		sequencer_set = 0
+		for _ in range(frame % len(self.sequencer_sets)):
+			sequencer_set = self.sequencer_sets[sequencer_set]['next']
+		return sequencer_set
+
+	def _latch_timestamp(self):
+		elapsed = time.perf_counter_ns() - self.clock_origin
+		self.state['TimestampLatchValue'] = int(elapsed * (1 + self.drift_ppm * 1e-6))
+
+	def power_cycle(self):
+		""" Drops every node value that isn't stored in a user set """
+
+		user_set_state = {key: value for key, value in self.state.items()
+			if isinstance(key, str) and key.startswith(('UserSet', 'TLDevice.'))}
+		self.state = user_set_state
+		self.initialized = False
+
+	def clear_log(self):
+		self.reads = []
+		self.writes = []
+
+	def _save_user_set(self):
+		self.user_sets[self.state.get('UserSetSelector')] = copy.deepcopy({key: value
+			for key, value in self.state.items()
+			if not (isinstance(key, str) and key.startswith(('UserSet', 'TLDevice.')))})
+
+	def _load_user_set(self):
+		self._restore(self.state.get('UserSetSelector'))
+
+	def _restore(self, user_set):
+		if user_set not in self.user_sets:
+			raise RuntimeError('User set ' + str(user_set) + ' was never saved on the fake camera')
+		self.state.update(copy.deepcopy(self.user_sets[user_set]))
+
+
+if __name__ == '__main__':
+	# Self-check of the config code against fake cameras, needs PySpin importable
+	import os
+	import tempfile
+	from concurrent.futures import ThreadPoolExecutor
+	from utils import load_config, warm_start
+
+	config = load_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'side.yaml'))
+	cams = [FakeCamera(serial) for serial in ('A', 'B', 'C')]
+	for cam in cams:
+		cam.Init()
+		# A slow UserSetSave keeps the cameras' cache updates overlapping
+		save = cam.commands['UserSetSave']
+		cam.commands['UserSetSave'] = lambda save=save: (time.sleep(0.2), save())
+
+	config.apply(cams[0], diff = False)
+	assert not config.plan(cams[0])[1], 'plan reports changes right after apply'
+
+	# Re-arming an armed camera keeps its trigger on: TriggerMode is written
+	# Off and On around selector writes, both under one key
+	import PySpin
+	from camera import PRIMARY_TRIGGER, SECONDARY_TRIGGER, counter_trigger
+	for trigger_config in (counter_trigger(200), PRIMARY_TRIGGER, SECONDARY_TRIGGER):
+		cam = FakeCamera('armed')
+		cam.Init()
+		trigger_config.apply(cam)
+		trigger_config.apply(cam)
+		assert not trigger_config.plan(cam)[0], trigger_config.yaml_path + ' re-arms with writes left over'
+	counter_trigger(200).apply(cam)
+	counter_trigger(150).apply(cam)
+	assert cam.TriggerMode.GetValue() == PySpin.TriggerMode_On, 'changing the counter rate left TriggerMode Off'
+
+	# Lowering the rate of an armed counter triggered primary, as
+	# async_record --bandwidth lower does, keeps it triggering
+	from camera import Camera
+	from utils import CameraConfig
+	counter_config = CameraConfig(config.yaml_path, dict(config.yaml_dict, role = 'primary',
+		trigger = {'source': 'counter'}), None)
+	primary = Camera(FakeCamera(config.serial), counter_config, arm = False)
+	primary.arm_trigger()
+	primary.arm_trigger(150)
+	assert primary.cam.TriggerMode.GetValue() == PySpin.TriggerMode_On, 're-arming left the primary untriggered'
+	assert abs(primary.trigger_rate() - 150) < 0.01, primary.trigger_rate()
+
+	# Switching tasks on one power cycle: a task without an ROI undoes the
+	# ROI of the one before and records the full sensor
+	from rig import find_configs
+	from tasks import load_task, task_configs
+	from utils import SENSOR_WIDTH, SENSOR_HEIGHT
+	cam = FakeCamera(config.serial)
+	for task in ('treadmill', 'open-field'):
+		side = next(task_config for task_config in task_configs(load_task(task), find_configs())
+			if task_config.name == 'side')
+		camera = Camera(cam, side, arm = False)
+		camera.check_geometry()
+	assert (cam.Width.GetValue(), cam.Height.GetValue()) == (SENSOR_WIDTH, SENSOR_HEIGHT), 'open-field frames are cropped'
+
+	# A dry plan leaves every selector as it found it
+	cam.LineSelector.SetValue(PySpin.LineSelector_Line0)
+	counter_trigger(100).plan(cam)
+	assert cam.LineSelector.GetValue() == PySpin.LineSelector_Line0, 'plan left a selector switched'
+	selectors = {key: value for key, value in cams[0].state.items() if key in SELECTORS.values()}
+	config.plan(cams[0])
+	assert selectors == {key: value for key, value in cams[0].state.items() if key in SELECTORS.values()}, \
+		'plan left a selector switched'
+
+	cache_path = os.path.join(tempfile.mkdtemp(), 'usersets.json')
+	with ThreadPoolExecutor(len(cams)) as pool:
+		results = list(pool.map(lambda cam: warm_start(cam, config, cache_path = cache_path), cams))
+	assert results == ['saved'] * len(cams), results
+	# Loading the user set undoes changes made since it was saved
+	for cam in cams:
+		cam.state['ExposureTime'] = 1
+	with ThreadPoolExecutor(len(cams)) as pool:
+		results = list(pool.map(lambda cam: warm_start(cam, config, cache_path = cache_path, verify = True), cams))
+	assert results == ['loaded'] * len(cams), results
+	print('fake camera self-check passed')
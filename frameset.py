@@ -0,0 +1,249 @@
+import argparse
+import heapq
+import os
+from clocksync import load_clock, to_host
+from metadata import read_frames, read_metadata
+
+FRAMESETS_FILE = 'framesets.csv'
+# How far an interval may be off a whole number of trigger periods, as a
+# fraction of the period, before the frame is flagged
+TOLERANCE = 0.25
+# Sets waiting for a member, at most. Beyond this the oldest is given up on,
+# so a camera that stops delivering cannot grow memory
+MAX_PENDING = 400
+
+
+class FrameSetAssembler:
+	def __init__(self, names, fps, path=None, tolerance=TOLERANCE, max_pending=MAX_PENDING, primary=None,
+				 clock=None):
+
+		"""
+		Groups the frames of all cameras into sets, one per trigger. Every
+		camera's frames must be added in the order they were grabbed, and all
+		cameras must be streaming before the primary starts triggering.
+
+		A camera's first frame is placed by clock, a function mapping
+		(name, camera timestamp) to host clock ns or None (e.g.
+		ClockSync.host_time): at the number of trigger periods between it and
+		the primary's first frame, whose frames of that camera wait until the
+		primary delivers. Without a clock mapping or a timestamp it is placed
+		at its frame id, which counts triggers from the start of the stream.
+		After that a frame's trigger index is advanced by the number of
+		trigger periods since the camera's last frame, measured on its
+		Timestamp chunk (or by the frame id step without one), so dropped
+		frames and missed triggers do not shift the following sets. With a
+		clock, sets whose members' host times spread by more than the
+		tolerance are flagged as skewed. Sets are written to path as csv if
+		given
+		"""
+		self.names = list(names)
+		self.period = 1e9 / fps
+		self.tolerance = tolerance
+		self.max_pending = max_pending
+		self.primary = primary
+		self.clock = clock
+		# Host time of trigger 0, from the primary's first frame
+		self.origin = None
+		self.waiting = []
+		self.last = {}
+		self.pending = {}
+		self.order = []
+		self.emitted = -1
+		self.stats = {'sets': 0, 'complete': 0, 'late': 0, 'skewed': 0,
+					  'missing': dict.fromkeys(self.names, 0), 'jitter': dict.fromkeys(self.names, 0)}
+		self.file = None
+		if path is not None:
+			self.file = open(path, 'w', newline = '')
+			self.file.write(','.join(['index'] + self.names + ['missing', 'jitter', 'skew_us']) + '\n')
+
+	def _host_time(self, name, timestamp):
+		if self.clock is None or timestamp is None:
+			return None
+		return self.clock(name, timestamp)
+
+	def _first_index(self, name, frame_id, host_time):
+		if self.origin is None or host_time is None:
+			return frame_id
+		return int(round((host_time - self.origin) / self.period))
+
+	def _trigger_index(self, name, frame_id, timestamp, host_time):
+		""" Returns the trigger index of a camera's next frame and whether its
+		 interval was off the trigger period by more than the tolerance """
+
+		last = self.last.get(name)
+		jitter = False
+		if last is None:
+			index = self._first_index(name, frame_id, host_time)
+		else:
+			last_index, last_frame_id, last_timestamp = last
+			if timestamp is not None and last_timestamp is not None:
+				periods = (timestamp - last_timestamp) / self.period
+			else:
+				periods = frame_id - last_frame_id
+			step = int(round(periods))
+			jitter = step < 1 or abs(periods - step) > self.tolerance
+			index = last_index + max(step, 1)
+		self.last[name] = (index, frame_id, timestamp)
+		return index, jitter
+
+	def add(self, name, frame_id, timestamp=None):
+		""" Adds one camera frame and returns the sets that are now final,
+		 in trigger order """
+
+		frame = (name, frame_id, timestamp, self._host_time(name, timestamp))
+		if self.primary is None or self.clock is None or self.origin is not None:
+			return self._add(*frame)
+
+		# Trigger 0 is not placed yet
+		if name != self.primary:
+			self.waiting.append(frame)
+			if len(self.waiting) <= self.max_pending:
+				return []
+			print('WARNING: no frame from ' + self.primary + ' yet, placing first frames by frame id')
+			self.clock = None
+			frames = self.waiting
+		elif frame[3] is None:
+			print('WARNING: no host time for ' + self.primary + ', placing first frames by frame id')
+			self.clock = None
+			frames = self.waiting + [frame]
+		else:
+			self.origin = frame[3] - frame_id * self.period
+			frames = self.waiting + [frame]
+		self.waiting = []
+		done = []
+		for frame in frames:
+			done += self._add(*frame)
+		return done
+
+	def _add(self, name, frame_id, timestamp, host_time):
+		index, jitter = self._trigger_index(name, frame_id, timestamp, host_time)
+		if index <= self.emitted:
+			# Its set was already given up on
+			self.stats['late'] += 1
+			return []
+		frame_set = self.pending.get(index)
+		if frame_set is None:
+			frame_set = self.pending[index] = {'index': index, 'frames': {}, 'jitter': [], 'host_times': {}}
+			heapq.heappush(self.order, index)
+		frame_set['frames'][name] = (frame_id, timestamp)
+		if host_time is not None:
+			frame_set['host_times'][name] = host_time
+		if jitter:
+			frame_set['jitter'].append(name)
+		return self._emit()
+
+	def _emit(self, flush=False):
+		""" Pops sets off the front while they are complete, can no longer be
+		 completed (every camera has moved past them) or too many are waiting """
+
+		done = []
+		oldest = min(self.last[name][0] if name in self.last else -1 for name in self.names)
+		while self.order:
+			index = self.order[0]
+			frame_set = self.pending[index]
+			if not (flush or len(frame_set['frames']) == len(self.names) or index < oldest or
+					len(self.pending) > self.max_pending):
+				break
+			heapq.heappop(self.order)
+			del self.pending[index]
+			frame_set['missing'] = [name for name in self.names if name not in frame_set['frames']]
+			# Spread of the members' exposures on the host clock, if known
+			host_times = list(frame_set['host_times'].values())
+			frame_set['skew'] = max(host_times) - min(host_times) if len(host_times) > 1 else None
+			self._record(frame_set)
+			done.append(frame_set)
+		return done
+
+	def _record(self, frame_set):
+		self.emitted = frame_set['index']
+		self.stats['sets'] += 1
+		self.stats['complete'] += not frame_set['missing']
+		for name in frame_set['missing']:
+			self.stats['missing'][name] += 1
+		for name in frame_set['jitter']:
+			self.stats['jitter'][name] += 1
+		skewed = frame_set['skew'] is not None and frame_set['skew'] > self.tolerance * self.period
+		self.stats['skewed'] += skewed
+		if self.file is not None:
+			row = [frame_set['index']] + [frame_set['frames'].get(name, (-1, None))[0] for name in self.names]
+			row += [' '.join(frame_set['missing']), ' '.join(frame_set['jitter']),
+					'' if frame_set['skew'] is None else int(round(frame_set['skew'] / 1e3))]
+			self.file.write(','.join(str(value) for value in row) + '\n')
+
+	def close(self):
+		""" Emits every set still waiting and closes the csv. Returns them """
+
+		done = []
+		if self.waiting:
+			# The primary never delivered, so there is no trigger 0 to place by
+			self.clock = None
+			waiting, self.waiting = self.waiting, []
+			for frame in waiting:
+				done += self._add(*frame)
+		done += self._emit(flush = True)
+		if self.file is not None and not self.file.closed:
+			self.file.close()
+		return done
+
+
+def print_stats(stats):
+	print('%d frame sets, %d complete, %d frames too late for their set, %d skewed' %
+		(stats['sets'], stats['complete'], stats['late'], stats['skewed']))
+	for name in stats['missing']:
+		print('  %-8s missing from %d set(s), off-period interval in %d' %
+			(name, stats['missing'][name], stats['jitter'][name]))
+
+
+def assemble_session(session_dir, names, fps=None, tolerance=TOLERANCE):
+	""" Assembles the frame sets of a recorded session from the frames.csv
+	 sidecar in each camera's directory (session_dir/<name>) and writes
+	 them to session_dir/framesets.csv. The frame rate defaults to the one
+	 in the cameras' metadata.json. First frames are placed by the clock
+	 fits (clock.json) if every camera has one. Returns the stats """
+
+	frames = {}
+	fits = {}
+	primary = None
+	for name in names:
+		frames[name] = read_frames(os.path.join(session_dir, name))
+		if frames[name] is None:
+			raise RuntimeError('No ' + name + ' frames.csv in "' + session_dir + '"')
+		metadata = read_metadata(os.path.join(session_dir, name)) or {}
+		if fps is None:
+			fps = metadata.get('fps')
+		if metadata.get('role') == 'primary':
+			primary = name
+		fit = load_clock(os.path.join(session_dir, name))
+		if fit is not None:
+			fits[name] = fit
+	if fps is None:
+		raise RuntimeError('No frame rate in the session metadata, give one')
+
+	clock = None
+	if len(fits) == len(names):
+		clock = lambda name, timestamp: int(to_host(timestamp, fits[name]))
+	assembler = FrameSetAssembler(names, fps, os.path.join(session_dir, FRAMESETS_FILE), tolerance,
+								  primary = primary, clock = clock)
+	columns = {name: (frames[name]['frame_id'].tolist(),
+					  frames[name]['timestamp'].tolist() if 'timestamp' in frames[name].dtype.names else None)
+			   for name in names}
+	# Interleave the cameras row by row, as they arrive while recording
+	for i in range(max(len(frame_ids) for frame_ids, _ in columns.values())):
+		for name, (frame_ids, timestamps) in columns.items():
+			if i < len(frame_ids):
+				assembler.add(name, frame_ids[i], None if timestamps is None else timestamps[i])
+	assembler.close()
+	return assembler.stats
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Groups the frames of a recorded session into one set per trigger.')
+	parser.add_argument('session', type = str, help = 'Directory holding one directory per camera')
+	parser.add_argument('--cameras', metavar = 'name', type = str, nargs = '+', default = ['side', 'bottom', 'top'])
+	parser.add_argument('--fps', metavar = 'fps', type = float, default = None)
+	parser.add_argument('--tolerance', metavar = 'tolerance', type = float, default = TOLERANCE)
+	args = parser.parse_args()
+
+	stats = assemble_session(args.session, args.cameras, args.fps, args.tolerance)
+	print_stats(stats)
+	print('Written to ' + os.path.join(args.session, FRAMESETS_FILE))
@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import numpy as np
+from metadata import read_frames, read_metadata, FRAMES_FILE
+from clocksync import load_clock, to_host
+from frameset import FRAMESETS_FILE
+from tasks import read_task
+
+INTEGRITY_FILE = 'integrity.json'
+# Interval histogram bin edges, in trigger periods, centred on 0, 0.25 ... 4
+INTERVAL_BINS = np.arange(-0.125, 4.2, 0.25)
+# A frame further than this (in trigger periods) from the nearest primary
+# frame has no partner
+MAX_SKEW = 0.5
+
+
+def find_cameras(session_dir):
+	""" Returns the camera directories of a session: every subdirectory
+	 holding a frames.csv, by name """
+
+	return {name: os.path.join(session_dir, name) for name in sorted(os.listdir(session_dir))
+			if os.path.isfile(os.path.join(session_dir, name, FRAMES_FILE))}
+
+
+def session_cameras(session_dir):
+	""" Returns the camera directories of the cameras a session recorded,
+	 by name: the camera columns of its framesets.csv, or else the cameras
+	 in its task.json. Sessions with neither fall back to find_cameras """
+
+	names = None
+	path = os.path.join(session_dir, FRAMESETS_FILE)
+	if os.path.isfile(path):
+		with open(path) as file:
+			columns = file.readline().strip().split(',')
+		names = columns[1:columns.index('missing')]
+	elif (read_task(session_dir) or {}).get('cameras'):
+		names = read_task(session_dir)['cameras']
+	if names is None:
+		return find_cameras(session_dir)
+
+	cameras = {name: os.path.join(session_dir, name) for name in names}
+	missing = [name for name, frame_dir in cameras.items() if not os.path.isfile(os.path.join(frame_dir, FRAMES_FILE))]
+	if missing:
+		raise RuntimeError('No ' + FRAMES_FILE + ' for ' + ', '.join(missing) + ' in "' + session_dir + '"')
+	return cameras
+
+
+def check_camera(frames, period):
+	""" Frame count, frame id gaps and duplicates, and the interval
+	 histogram of one camera's frames.csv. period is the trigger period
+	 in ns """
+
+	frame_ids = frames['frame_id']
+	result = {'frames': len(frame_ids)}
+	if len(frame_ids) == 0:
+		return result
+
+	steps = np.diff(frame_ids)
+	unique_ids, counts = np.unique(frame_ids, return_counts = True)
+	result.update({
+		'first_id': int(frame_ids[0]),
+		'last_id': int(frame_ids[-1]),
+		'gaps': int(np.count_nonzero(steps > 1)),
+		'missing_ids': int(np.sum(steps[steps > 1] - 1)),
+		'gap_at': frame_ids[:-1][steps > 1][:20].tolist(),
+		'duplicates': int(np.sum(counts[counts > 1] - 1)),
+		'out_of_order': int(np.count_nonzero(steps < 0)),
+	})
+
+	if 'timestamp' in frames.dtype.names and len(frame_ids) > 1:
+		periods = np.diff(frames['timestamp']) / period
+		histogram, _ = np.histogram(np.clip(periods, INTERVAL_BINS[0], INTERVAL_BINS[-1]), INTERVAL_BINS)
+		whole = np.maximum(np.round(periods), 1)
+		result.update({
+			'interval_mean_us': float(np.mean(periods) * period / 1e3),
+			'interval_std_us': float(np.std(periods) * period / 1e3),
+			'interval_min_us': float(np.min(periods) * period / 1e3),
+			'interval_max_us': float(np.max(periods) * period / 1e3),
+			'interval_histogram': histogram.tolist(),
+			# Trigger periods without a frame, whether the frame was never
+			# exposed (missed trigger) or lost in transfer (frame id gap)
+			'missed_periods': int(np.sum(whole - 1)),
+			'missed_triggers': int(max(np.sum(whole - 1) - np.sum(steps[steps > 1] - 1), 0)),
+		})
+	return result
+
+
+def check_jitter(timestamps, period):
+	""" Deviation of a camera's frames from its own trigger clock, for
+	 sessions without clock fits: every frame gets a trigger index from
+	 the whole number of periods since the last one, and a line fitted
+	 through (index, timestamp) removes the camera's offset and drift.
+	 That also removes any offset to the other cameras, so this is not
+	 skew between cameras """
+
+	index = np.concatenate([[0], np.cumsum(np.maximum(np.round(np.diff(timestamps) / period), 1))])
+	if len(index) < 3:
+		return None
+	offsets = (timestamps - timestamps[0]).astype(np.float64)
+	slope, intercept = np.polyfit(index, offsets, 1)
+	jitter = offsets - (slope * index + intercept)
+	return {
+		'std_us': float(np.std(jitter) / 1e3),
+		'p1_us': float(np.percentile(jitter, 1) / 1e3),
+		'p99_us': float(np.percentile(jitter, 99) / 1e3),
+		'max_abs_us': float(np.max(np.abs(jitter)) / 1e3),
+		'off_clock': int(np.count_nonzero(np.abs(jitter) > MAX_SKEW * period)),
+	}
+
+
+def check_skew(times, primary, period):
+	""" Offset of every secondary frame from the nearest primary frame, in
+	 host time. Returns {name: stats} """
+
+	primary_times = np.sort(times[primary])
+	results = {}
+	for name, secondary_times in times.items():
+		if name == primary or len(secondary_times) == 0 or len(primary_times) == 0:
+			continue
+		after = np.clip(np.searchsorted(primary_times, secondary_times), 1, len(primary_times) - 1)
+		before = after - 1
+		nearest = np.where(np.abs(secondary_times - primary_times[before]) <= np.abs(primary_times[after] - secondary_times),
+						   primary_times[before], primary_times[after])
+		skew = (secondary_times - nearest).astype(np.float64)
+		results[name] = {
+			'median_us': float(np.median(skew) / 1e3),
+			'p1_us': float(np.percentile(skew, 1) / 1e3),
+			'p99_us': float(np.percentile(skew, 99) / 1e3),
+			'max_abs_us': float(np.max(np.abs(skew)) / 1e3),
+			'unpaired': int(np.count_nonzero(np.abs(skew) > MAX_SKEW * period)),
+		}
+	return results
+
+
+def check_session(session_dir, fps=None, primary=None):
+	""" Runs every check on a recorded session. The frame rate and primary
+	 default to the ones in the cameras' metadata.json. The skew between
+	 cameras is only measured if every camera has a clock fit, otherwise
+	 each camera's timing jitter is checked against its own clock """
+
+	cameras = session_cameras(session_dir)
+	if not cameras:
+		raise RuntimeError('No camera frames.csv found in "' + session_dir + '"')
+
+	frames, fits = {}, {}
+	for name, frame_dir in cameras.items():
+		frames[name] = read_frames(frame_dir)
+		fits[name] = load_clock(frame_dir)
+		metadata = read_metadata(frame_dir) or {}
+		fps = fps or metadata.get('fps')
+		if primary is None and metadata.get('role') == 'primary':
+			primary = name
+	if fps is None:
+		raise RuntimeError('No frame rate in the session metadata, give one')
+	period = 1e9 / fps
+
+	report = {'session': session_dir, 'fps': fps, 'primary': primary, 'cameras': {}, 'skew': {}, 'jitter': {}}
+	for name in cameras:
+		report['cameras'][name] = check_camera(frames[name], period)
+
+	timestamped = all('timestamp' in frames[name].dtype.names and len(frames[name]) for name in cameras)
+	if primary in cameras and timestamped and all(fits.values()):
+		times = {name: to_host(frames[name]['timestamp'], fits[name]) for name in cameras}
+		report['skew'] = check_skew(times, primary, period)
+	elif timestamped:
+		for name in cameras:
+			jitter = check_jitter(frames[name]['timestamp'], period)
+			if jitter is not None:
+				report['jitter'][name] = jitter
+
+	# Every secondary must have had exactly one trigger per primary exposure
+	report['problems'] = []
+	expected = report['cameras'].get(primary, {}).get('frames')
+	for name, result in report['cameras'].items():
+		if expected is not None and result['frames'] != expected:
+			report['problems'].append('%s has %d frames, %s has %d' % (name, result['frames'], primary, expected))
+		for key in ('gaps', 'duplicates', 'out_of_order', 'missed_triggers'):
+			if result.get(key):
+				report['problems'].append('%s: %d %s' % (name, result[key], key.replace('_', ' ')))
+	for name, result in report['skew'].items():
+		if result['unpaired']:
+			report['problems'].append('%s: %d frames more than %.1f periods from a %s frame' %
+				(name, result['unpaired'], MAX_SKEW, primary))
+	for name, result in report['jitter'].items():
+		if result['off_clock']:
+			report['problems'].append('%s: %d frames more than %.1f periods off its own trigger clock' %
+				(name, result['off_clock'], MAX_SKEW))
+	return report
+
+
+def print_report(report):
+	print('%-8s %8s %6s %8s %6s %8s %10s %10s %10s' % ('camera', 'frames', 'gaps', 'missing', 'dups',
+		'missed', 'mean us', 'std us', 'max us'))
+	for name, result in report['cameras'].items():
+		print('%-8s %8d %6d %8d %6d %8d %10.1f %10.1f %10.1f' % (name, result['frames'], result.get('gaps', 0),
+			result.get('missing_ids', 0), result.get('duplicates', 0), result.get('missed_triggers', 0),
+			result.get('interval_mean_us', 0), result.get('interval_std_us', 0), result.get('interval_max_us', 0)))
+
+	print('Frame intervals (trigger periods):')
+	for name, result in report['cameras'].items():
+		if 'interval_histogram' in result:
+			print('  %-8s ' % name + ' '.join('%.2f:%d' % (edge + 0.125, count)
+				for edge, count in zip(INTERVAL_BINS, result['interval_histogram']) if count))
+
+	if report['skew']:
+		print('Skew to %s (host clock, us):' % report['primary'])
+		for name, result in report['skew'].items():
+			print('  %-8s median %8.1f  p1 %8.1f  p99 %8.1f  max %8.1f  unpaired %d' % (name, result['median_us'],
+				result['p1_us'], result['p99_us'], result['max_abs_us'], result['unpaired']))
+	if report['jitter']:
+		print('Jitter against each camera\'s own trigger clock (no clock fits, skew between cameras not measured, us):')
+		for name, result in report['jitter'].items():
+			print('  %-8s std %8.1f  p1 %8.1f  p99 %8.1f  max %8.1f  off clock %d' % (name, result['std_us'],
+				result['p1_us'], result['p99_us'], result['max_abs_us'], result['off_clock']))
+
+	for problem in report['problems']:
+		print('PROBLEM: ' + problem)
+	if not report['problems']:
+		print('No problems found')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Checks the frames of a recorded session for dropped and missed triggers.')
+	parser.add_argument('session', type = str, help = 'Directory holding one directory per camera')
+	parser.add_argument('--fps', metavar = 'fps', type = float, default = None)
+	parser.add_argument('--primary', metavar = 'name', type = str, default = None)
+	args = parser.parse_args()
+
+	report = check_session(args.session, args.fps, args.primary)
+	print_report(report)
+	with open(os.path.join(args.session, INTEGRITY_FILE), 'w') as file:
+		json.dump(report, file, indent = 1)
+	if report['problems']:
+		raise SystemExit(1)
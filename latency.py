@@ -0,0 +1,157 @@
+import PySpin
+import argparse
+import bisect
+import json
+import os
+import threading
+import numpy as np
+from clocksync import HOST_CLOCK
+
+LATENCY_FILE = 'latency.json'
+# Stages a frame goes through, each timed from the end of the previous one:
+# exposure end (device event) -> received by the host -> taken off the save
+# queue -> written to disk
+STAGES = ('transfer', 'queue', 'save', 'total')
+# Histogram bin edges in us, log spaced from 10 us to 10 s
+BINS_US = np.logspace(1, 7, 61).tolist()
+# Frames being tracked per camera, at most. Frames that never complete (e.g.
+# dropped in transfer) are forgotten oldest first beyond this
+MAX_PENDING = 2000
+
+
+class ExposureEndHandler(PySpin.DeviceEventHandler):
+	def __init__(self, camera, tracker):
+
+		"""
+		Device event handler for EventExposureEnd, as in the DeviceEvents
+		example. The camera must have ExposureEnd in its "events" section.
+		The driver calls it on its own thread as the event arrives, and
+		the frame id is read from the event data, which needs no camera
+		round trip
+		"""
+		super(ExposureEndHandler, self).__init__()
+		self.camera = camera
+		self.tracker = tracker
+
+	def OnDeviceEvent(self, eventname):
+		if eventname == 'EventExposureEnd':
+			self.tracker.exposure_end(self.camera.serial, self.camera.cam.EventExposureEndFrameID.GetValue())
+
+
+def register_exposure_end(camera, tracker):
+	handler = ExposureEndHandler(camera, tracker)
+	camera.cam.RegisterEventHandler(handler, 'EventExposureEnd')
+	return handler
+
+
+class LatencyTracker:
+	def __init__(self, names):
+
+		"""
+		Times every frame through the recorder's stages and keeps a latency
+		histogram per camera and stage. names maps camera serial to name.
+		Each stage is stamped with the host clock as it happens, and a
+		frame's record is dropped once it is saved, so memory stays bounded
+		"""
+		self.names = dict(names)
+		self.lock = threading.Lock()
+		self.pending = {serial: {} for serial in self.names}
+		self.histograms = {serial: {stage: [0] * (len(BINS_US) + 1) for stage in STAGES} for serial in self.names}
+		self.counts = {serial: {'frames': 0, 'no_event': 0, 'forgotten': 0} for serial in self.names}
+
+	def _stamp(self, serial, frame_id, stage):
+		now = HOST_CLOCK()
+		with self.lock:
+			pending = self.pending[serial]
+			record = pending.get(frame_id)
+			if record is None:
+				record = pending[frame_id] = {}
+				if len(pending) > MAX_PENDING:
+					del pending[next(iter(pending))]
+					self.counts[serial]['forgotten'] += 1
+			record[stage] = now
+			return record
+
+	def exposure_end(self, serial, frame_id):
+		self._stamp(serial, frame_id, 'exposure_end')
+
+	def received(self, serial, frame_id):
+		self._stamp(serial, frame_id, 'received')
+
+	def dequeued(self, serial, frame_id):
+		self._stamp(serial, frame_id, 'dequeued')
+
+	def saved(self, serial, frame_id):
+		""" Closes a frame's record and adds its stages to the histograms """
+
+		record = self._stamp(serial, frame_id, 'saved')
+		with self.lock:
+			self.pending[serial].pop(frame_id, None)
+			self.counts[serial]['frames'] += 1
+			stages = {'queue': (record.get('received'), record.get('dequeued')),
+					  'save': (record.get('dequeued'), record['saved'])}
+			if 'exposure_end' in record:
+				stages['transfer'] = (record['exposure_end'], record.get('received'))
+				stages['total'] = (record['exposure_end'], record['saved'])
+			else:
+				self.counts[serial]['no_event'] += 1
+			for stage, (start, end) in stages.items():
+				if start is not None and end is not None:
+					self.histograms[serial][stage][bisect.bisect(BINS_US, (end - start) / 1e3)] += 1
+
+	def report(self):
+		""" Returns {camera name: {stage: stats}} with count, median, p99
+		 and max bin (us) of every stage, read off the histograms """
+
+		report = {}
+		for serial, name in self.names.items():
+			report[name] = dict(self.counts[serial], stages = {})
+			for stage in STAGES:
+				counts = np.array(self.histograms[serial][stage])
+				total = counts.sum()
+				if total == 0:
+					continue
+				# Upper edge of the bin holding each quantile
+				edges = BINS_US + [float('inf')]
+				cumulative = np.cumsum(counts)
+				report[name]['stages'][stage] = {
+					'frames': int(total),
+					'median_us': edges[int(np.searchsorted(cumulative, total * 0.5))],
+					'p99_us': edges[int(np.searchsorted(cumulative, total * 0.99))],
+					'max_us': edges[int(np.nonzero(counts)[0][-1])],
+					'histogram': counts.tolist(),
+				}
+		return report
+
+	def save(self, path):
+		report = self.report()
+		with open(path, 'w') as file:
+			json.dump({'bins_us': BINS_US, 'cameras': report}, file, indent = 1)
+		return report
+
+
+def print_latency(report, fps=None):
+	""" Prints the median and p99 of every stage, flagging stages whose p99
+	 takes more than a frame period at fps """
+
+	print('Latency per stage (us, upper bin edge, median / p99):')
+	print('%-8s ' % 'camera' + ''.join('%20s' % stage for stage in STAGES))
+	for name, result in report.items():
+		print('%-8s ' % name + ''.join('%20s' % ('%.0f / %.0f' % (result['stages'][stage]['median_us'],
+			result['stages'][stage]['p99_us']) if stage in result['stages'] else '-') for stage in STAGES))
+		if result['no_event'] or result['forgotten']:
+			print('  %d frames without an exposure end event, %d never saved' % (result['no_event'], result['forgotten']))
+		if fps is not None:
+			for stage in ('transfer', 'queue', 'save'):
+				if stage in result['stages'] and result['stages'][stage]['p99_us'] > 1e6 / fps:
+					print('  WARNING: %s p99 is longer than a %.0f fps frame period' % (stage, fps))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Prints the latency report of a recorded session.')
+	parser.add_argument('session', type = str)
+	parser.add_argument('--fps', metavar = 'fps', type = float, default = None)
+	args = parser.parse_args()
+
+	with open(os.path.join(args.session, LATENCY_FILE)) as file:
+		print_latency(json.load(file)['cameras'], args.fps)
@@ -0,0 +1,120 @@
+import json
+import os
+import numpy as np
+
+METADATA_FILE = 'metadata.json'
+FRAMES_FILE = 'frames.csv'
+# Directory, under the camera's, holding the frames of one sequencer set
+SEQUENCER_DIR = 'set%d'
+
+# frames.csv column for each chunk, chunks not listed keep their own name
+CHUNK_COLUMNS = {
+	'Timestamp': 'timestamp',
+	'FrameID': 'chunk_frame_id',
+	'ExposureTime': 'exposure_time',
+	'Gain': 'gain',
+	'ExposureEndLineStatusAll': 'line_status',
+	'SequencerSetActive': 'sequencer_set',
+}
+# frames.csv columns holding floats, the others are integers
+FLOAT_COLUMNS = ('exposure_time', 'gain')
+
+# numpy dtype of a raw frame for each pixel format
+PIXEL_DTYPES = {'Mono8': 'uint8', 'Mono16': 'uint16'}
+
+
+def write_metadata(save_dir, camera, fps):
+	""" Writes the frame geometry a configured Camera actually produces
+	 (read back from the camera, not from the yaml) next to its frames, so
+	 raw2img and other readers know how to reshape the raw files """
+
+	cam = camera.cam
+	metadata = {
+		'camera': camera.cam_name,
+		'serial': camera.serial,
+		'role': camera.config.role,
+		'fps': fps,
+		'width': cam.Width.GetValue(),
+		'height': cam.Height.GetValue(),
+		'offset_x': cam.OffsetX.GetValue(),
+		'offset_y': cam.OffsetY.GetValue(),
+		'binning': cam.BinningHorizontal.GetValue(),
+		'pixel_format': cam.PixelFormat.GetCurrentEntry().GetSymbolic(),
+		'roi': camera.config.roi,
+		'chunks': camera.config.chunks,
+		'trigger': camera.config.trigger,
+		'ttl_lines': camera.config.ttl_lines,
+		'sequencer': camera.config.sequencer,
+	}
+	with open(os.path.join(save_dir, METADATA_FILE), 'w') as file:
+		json.dump(metadata, file, indent = 1)
+	return metadata
+
+
+def sequencer_dir(save_dir, sequencer_set):
+	return os.path.join(save_dir, SEQUENCER_DIR % sequencer_set)
+
+
+def read_metadata(frame_dir):
+	""" Returns the metadata written next to a camera's frames, or None if
+	 the directory has none (sessions recorded before it existed) """
+
+	path = os.path.join(frame_dir, METADATA_FILE)
+	if not os.path.isfile(path):
+		return None
+	with open(path) as file:
+		return json.load(file)
+
+
+class FrameLog:
+	def __init__(self, save_dir, chunks, sequencer_sets=0):
+
+		"""
+		Per-frame sidecar (frames.csv) written next to a camera's frames.
+		Every row holds the frame id the frame is saved under followed by
+		the value of each enabled chunk, read from the image's chunk data
+		so it costs no extra camera reads. With sequencer_sets, every row
+		also goes to the frames.csv in its set's directory (see
+		sequencer_dir), so each set's stack has its own
+		"""
+		self.chunks = list(chunks)
+		self.getters = ['Get' + chunk for chunk in self.chunks]
+		self.columns = ['frame_id'] + [CHUNK_COLUMNS.get(chunk, chunk) for chunk in self.chunks]
+		self.file = open(os.path.join(save_dir, FRAMES_FILE), 'w', newline = '')
+		self.set_files = [open(os.path.join(sequencer_dir(save_dir, sequencer_set), FRAMES_FILE), 'w', newline = '')
+						  for sequencer_set in range(sequencer_sets)]
+		for file in [self.file] + self.set_files:
+			file.write(','.join(self.columns) + '\n')
+
+	def write(self, image):
+		""" Logs a complete image, must be called before it is released.
+		 Returns the logged values by column """
+
+		row = [image.GetFrameID()]
+		if self.getters:
+			chunk_data = image.GetChunkData()
+			row += [getattr(chunk_data, getter)() for getter in self.getters]
+		line = ','.join(str(value) for value in row) + '\n'
+		self.file.write(line)
+		values = dict(zip(self.columns, row))
+		if self.set_files and 0 <= values['sequencer_set'] < len(self.set_files):
+			self.set_files[values['sequencer_set']].write(line)
+		return values
+
+	def close(self):
+		for file in [self.file] + self.set_files:
+			if not file.closed:
+				file.close()
+
+
+def read_frames(frame_dir):
+	""" Returns the frames.csv sidecar of a camera's frames as a structured
+	 array with one field per column, or None if there is none """
+
+	path = os.path.join(frame_dir, FRAMES_FILE)
+	if not os.path.isfile(path):
+		return None
+	with open(path) as file:
+		columns = file.readline().strip().split(',')
+	dtype = [(column, np.float64 if column in FLOAT_COLUMNS else np.int64) for column in columns]
+	return np.atleast_1d(np.loadtxt(path, delimiter = ',', skiprows = 1, dtype = dtype, ndmin = 1))
@@ -0,0 +1,103 @@
+import cv2
+import numpy as np
+import os
+import json
+
+LEVELS = (2, 4, 8)
+CHUNK_SIZE = 1000
+INDEX_FILE = 'index.json'
+CHUNK_FILE = 'chunk_%05d.npz'
+
+
+class PyramidWriter:
+	def __init__(self, out_dir: str, levels=LEVELS, chunk_size: int = CHUNK_SIZE):
+
+		"""
+		Writes downsampled copies of every frame added, one directory per
+		level holding zlib compressed .npz chunks of chunk_size frames
+		"""
+		self.out_dir = out_dir
+		self.levels = sorted(levels)
+		self.chunk_size = chunk_size
+		self.buffers = {level: [] for level in self.levels}
+		self.shapes = {}
+		self.num_chunks = 0
+		self.frames = []
+		for level in self.levels:
+			os.makedirs(self._level_dir(level), exist_ok = True)
+
+	def _level_dir(self, level):
+		return os.path.join(self.out_dir, 'L' + str(level))
+
+	def add(self, img, frame_id, source: str):
+		""" Downsamples img to every level, each level is made from the
+		 previous one so the full frame is only read once """
+
+		factor = 1
+		for level in self.levels:
+			img = cv2.resize(img, (img.shape[1] * factor // level, img.shape[0] * factor // level),
+				interpolation = cv2.INTER_AREA)
+			factor = level
+			self.buffers[level].append(img)
+			self.shapes[level] = img.shape
+		self.frames.append((int(frame_id), source))
+
+		if len(self.buffers[self.levels[0]]) == self.chunk_size:
+			self._flush()
+
+	def _flush(self):
+		if not self.buffers[self.levels[0]]:
+			return
+		for level in self.levels:
+			path = os.path.join(self._level_dir(level), CHUNK_FILE % self.num_chunks)
+			np.savez_compressed(path, frames = np.stack(self.buffers[level]))
+			self.buffers[level] = []
+		self.num_chunks += 1
+
+	def close(self):
+		""" Writes the last partial chunk and the index """
+
+		self._flush()
+		index = {
+			'levels': self.levels,
+			'shapes': {str(level): list(shape) for level, shape in self.shapes.items()},
+			'chunk_size': self.chunk_size,
+			'num_chunks': self.num_chunks,
+			'frame_ids': [frame_id for frame_id, _ in self.frames],
+			'sources': [source for _, source in self.frames],
+		}
+		with open(os.path.join(self.out_dir, INDEX_FILE), 'w') as file:
+			json.dump(index, file)
+
+
+class PyramidReader:
+	def __init__(self, out_dir: str):
+
+		"""
+		Opens a preview pyramid written by PyramidWriter
+		"""
+		self.out_dir = out_dir
+		with open(os.path.join(out_dir, INDEX_FILE)) as file:
+			self.index = json.load(file)
+		self.frame_ids = np.asarray(self.index['frame_ids'])
+
+	def load(self, level: int):
+		""" Returns every frame of a session at the given level as one
+		 (T, H, W) array """
+
+		if level not in self.index['levels']:
+			raise RuntimeError('Level ' + str(level) + ' not in pyramid, available: ' + str(self.index['levels']))
+		return np.concatenate([self.chunk(level, i) for i in range(self.index['num_chunks'])])
+
+	def chunk(self, level: int, i: int):
+		""" Returns the frames of a single chunk, i.e. frames
+		 [i * chunk_size, (i + 1) * chunk_size) """
+
+		with np.load(os.path.join(self.out_dir, 'L' + str(level), CHUNK_FILE % i)) as chunk:
+			return chunk['frames']
+
+	def source(self, i: int):
+		""" Returns the path of the full resolution frame behind preview
+		 frame i """
+
+		return self.index['sources'][i]
@@ -1,36 +1,343 @@
 import cv2
 import numpy as np
 import os
-import matplotlib.pyplot as plt
 import argparse
+import tempfile
+import time
 from tqdm import tqdm
+from preview import PyramidWriter
+from metadata import read_metadata, read_frames, PIXEL_DTYPES
+
+FRAME_HEIGHT = 1080
+FRAME_WIDTH = 1440
+RAW_EXT = '.raw'
+NPY_EXT = '.npy'
+
+# Encoder presets. OpenCV's default PNG level spends most of the conversion
+# time in zlib, the faster presets trade file size for throughput. Presets with
+# a 'stack' write N frames into one multi-page TIFF.
+ENCODERS = {
+	'png': {'ext': '.png', 'params': [cv2.IMWRITE_PNG_COMPRESSION, 3]},
+	'png-fast': {'ext': '.png', 'params': [cv2.IMWRITE_PNG_COMPRESSION, 1]},
+	'png-store': {'ext': '.png', 'params': [cv2.IMWRITE_PNG_COMPRESSION, 0]},
+	'tiff': {'ext': '.tiff', 'params': [cv2.IMWRITE_TIFF_COMPRESSION, 1]},
+	'tiff-stack': {'ext': '.tiff', 'params': [cv2.IMWRITE_TIFF_COMPRESSION, 1], 'stack': 100},
+}
 
 parser = argparse.ArgumentParser(description='Converts All Raw Images in Directory to Output Directory.')
 
-#parser.add_argument('--input', metavar = 'input', type = str, default = 'D:\\top')
-#parser.add_argument('--output', metavar = 'output', type = str, default = 'D:\\top')
-
-file_input = 'R:\\Core_Facilities\\PI\\Bevan_Lab_mbe377\\Open Field\\Multi-Cam Open Field\\Open filed - Male\\8458 - HET - NULL - 9 mth - Male\\'
-file_output = 'R:\\Core_Facilities\\PI\\Bevan_Lab_mbe377\\Open Field\\Multi-Cam Open Field\\Open filed - Male\\8458 - HET - NULL - 9 mth - Male - converted\\'
-
-#args = parser.parse_args()
-try:
-	os.makedirs(file_output)
-	print('Output Directory Created')
-except OSError as e:
-	print('Output Directory Already Exists')
-
-for img in tqdm(os.listdir(file_input)):
-	name = img
-	folder = name.split('-')[0]
-	img = file_input + img
-	img = np.fromfile(img, dtype = np.uint8).reshape(1080, 1440)
-	#plt.imshow(img)
-	#plt.show()
-	
-	try:
-		os.makedirs(file_output + folder)
-		print('Output Subdirectory Created')
-	except OSError as e:	
-		continue
-	cv2.imwrite(file_output + folder + '\\' + name[:-4] +'.png', img)
\ No newline at end of file
+parser.add_argument('--input', metavar = 'input', type = str,
+	default = 'R:\\Core_Facilities\\PI\\Bevan_Lab_mbe377\\Open Field\\Multi-Cam Open Field\\Open filed - Male\\8458 - HET - NULL - 9 mth - Male\\')
+parser.add_argument('--output', metavar = 'output', type = str,
+	default = 'R:\\Core_Facilities\\PI\\Bevan_Lab_mbe377\\Open Field\\Multi-Cam Open Field\\Open filed - Male\\8458 - HET - NULL - 9 mth - Male - converted\\')
+parser.add_argument('--overwrite', action = 'store_true',
+	help = 'Convert frames even if the output file already exists')
+parser.add_argument('--encoder', metavar = 'encoder', type = str, default = 'png-fast',
+	choices = sorted(ENCODERS))
+parser.add_argument('--level', metavar = 'level', type = int, default = None,
+	help = 'zlib level (0-9) overriding the PNG preset')
+parser.add_argument('--stack', metavar = 'stack', type = int, default = None,
+	help = 'Frames per multi-page TIFF for tiff-stack')
+parser.add_argument('--export-stack', action = 'store_true',
+	help = 'Write each group into one (T, H, W) .npy stack plus frame id and timestamp arrays')
+parser.add_argument('--preview', action = 'store_true',
+	help = 'Also write a 1/2, 1/4, 1/8 preview pyramid for each group in the same pass')
+parser.add_argument('--benchmark', metavar = 'frames', type = int, default = 0,
+	help = 'Benchmark every encoder preset on this many sampled frames and exit')
+
+
+def group_key(name):
+	""" Returns the output subdirectory a raw frame belongs to. Frames are
+	 grouped by the prefix before the first '-' (e.g. 'top-123.Raw' -> 'top'),
+	 frames without a prefix go straight into the output directory """
+
+	stem = os.path.splitext(name)[0]
+	if '-' not in stem:
+		return ''
+	return stem.split('-')[0]
+
+
+def frame_key(name):
+	""" Sort key putting frames in frame number order ('top-9' before
+	 'top-10'), falling back to the name when it has no trailing number """
+
+	stem = os.path.splitext(name)[0]
+	number = stem.split('-')[-1]
+	if number.isdigit():
+		return (stem[:-len(number)], int(number))
+	return (stem, -1)
+
+
+def get_encoder(name, level=None, stack=None):
+	""" Returns a copy of an encoder preset with the optional zlib level and
+	 stack size applied """
+
+	if name not in ENCODERS:
+		raise RuntimeError('Unknown encoder "' + name + '", choose one of: ' + ', '.join(sorted(ENCODERS)))
+	encoder = dict(ENCODERS[name], name = name)
+	encoder['params'] = list(encoder['params'])
+	if level is not None:
+		if encoder['ext'] != '.png':
+			raise RuntimeError('--level only applies to the PNG encoders')
+		encoder['params'][1] = level
+	if stack is not None:
+		if 'stack' not in encoder:
+			raise RuntimeError('--stack only applies to the tiff-stack encoder')
+		encoder['stack'] = stack
+	return encoder
+
+
+def list_frames(file_input, exts=(RAW_EXT,)):
+	""" Groups the frame files in file_input by group_key, each group in frame
+	 order. Returns the groups and the (path, reason) of every file ignored """
+
+	groups = {}
+	skipped = []
+	for name in os.listdir(file_input):
+		src = os.path.join(file_input, name)
+		if not os.path.isfile(src):
+			continue
+		if os.path.splitext(name)[1].lower() not in exts:
+			skipped.append((src, 'not a frame file'))
+			continue
+		groups.setdefault(group_key(name), []).append(name)
+
+	for names in groups.values():
+		names.sort(key = frame_key)
+	return groups, skipped
+
+
+def build_plan(file_input, file_output, encoder, overwrite=False):
+	""" Works out the whole conversion before anything is written. Returns a
+	 dict holding the (inputs, output) pairs to convert, the output
+	 directories they need and the inputs that are skipped, with a reason.
+	 Pairs whose output already exists are kept apart in "converted", for
+	 the preview. Each job has a single input unless the encoder writes
+	 stacks """
+
+	plan = {'jobs': [], 'converted': [], 'dirs': set(), 'skipped': [], 'encoder': encoder}
+	plan['shape'], plan['dtype'] = frame_format(file_input)
+	groups, plan['skipped'] = list_frames(file_input)
+
+	stack = encoder.get('stack', 1)
+	for key, names in sorted(groups.items()):
+		out_dir = os.path.join(file_output, key)
+		for i in range(0, len(names), stack):
+			chunk = names[i:i + stack]
+			stem = os.path.splitext(chunk[0])[0]
+			if 'stack' in encoder:
+				stem += '-stack'
+			dst = os.path.join(out_dir, stem + encoder['ext'])
+			srcs = [os.path.join(file_input, name) for name in chunk]
+			if not overwrite and os.path.exists(dst):
+				plan['skipped'].extend((src, 'already converted') for src in srcs)
+				plan['converted'].append((srcs, dst))
+				continue
+
+			plan['dirs'].add(out_dir)
+			plan['jobs'].append((srcs, dst))
+
+	return plan
+
+
+def write_frames(imgs, dst, encoder):
+	""" Encodes one frame, or a stack of frames, to dst """
+
+	if 'stack' in encoder:
+		return cv2.imwritemulti(dst, imgs, encoder['params'])
+	return cv2.imwrite(dst, imgs[0], encoder['params'])
+
+
+def frame_format(file_input):
+	""" Returns the (height, width) and dtype of the raw frames in file_input
+	 from the metadata the recorder writes next to them, falling back to
+	 full frame Mono8 """
+
+	metadata = read_metadata(file_input)
+	if metadata is None:
+		return (FRAME_HEIGHT, FRAME_WIDTH), np.uint8
+	if metadata['pixel_format'] not in PIXEL_DTYPES:
+		raise RuntimeError('Cannot read ' + metadata['pixel_format'] + ' frames, supported: ' + ', '.join(sorted(PIXEL_DTYPES)))
+	return (metadata['height'], metadata['width']), np.dtype(PIXEL_DTYPES[metadata['pixel_format']])
+
+
+def read_raw(path, shape=(FRAME_HEIGHT, FRAME_WIDTH), dtype=np.uint8):
+	""" Reads a single raw frame, or a frame saved with np.save """
+
+	if path.lower().endswith(NPY_EXT):
+		return np.load(path)
+	return np.fromfile(path, dtype = dtype).reshape(shape)
+
+
+def run_plan(plan, preview=False):
+	""" Creates the output directories once, then converts every planned
+	 frame, optionally feeding a preview pyramid per output directory.
+	 The pyramid is rebuilt from every frame of the directory, frames
+	 converted by an earlier run are read again just for it. Returns the
+	 converted/skipped/failed counts and the failures """
+
+	for out_dir in sorted(plan['dirs']):
+		os.makedirs(out_dir, exist_ok = True)
+	jobs = [(srcs, dst, True) for srcs, dst in plan['jobs']]
+	pyramids = {}
+	if preview:
+		jobs += [(srcs, dst, False) for srcs, dst in plan['converted']]
+		jobs.sort(key = lambda job: (os.path.normpath(os.path.dirname(job[1])), frame_key(os.path.basename(job[0][0]))))
+		for _, dst, _ in jobs:
+			out_dir = os.path.normpath(os.path.dirname(dst))
+			if out_dir not in pyramids:
+				pyramids[out_dir] = PyramidWriter(os.path.join(out_dir, 'preview'))
+
+	report = {'converted': 0, 'skipped': len(plan['skipped']), 'failed': 0, 'failures': []}
+	for srcs, dst, convert in tqdm(jobs):
+		# Unreadable or locked files (e.g. on the network share), truncated
+		# frames and encoder errors fail the job, not the run
+		try:
+			imgs = [read_raw(src, plan['shape'], plan['dtype']) for src in srcs]
+			written = write_frames(imgs, dst, plan['encoder']) if convert else True
+		except (OSError, ValueError, cv2.error) as e:
+			if convert:
+				report['failed'] += len(srcs)
+				report['failures'].append((dst, str(e)))
+			else:
+				report['failures'].append((dst, 'preview only: ' + str(e)))
+			continue
+		if not written:
+			report['failed'] += len(srcs)
+			report['failures'].append((dst, 'could not write ' + dst))
+			continue
+		if convert:
+			report['converted'] += len(srcs)
+		if preview:
+			for img, src in zip(imgs, srcs):
+				pyramids[os.path.normpath(os.path.dirname(dst))].add(img, frame_key(os.path.basename(src))[1], src)
+
+	for pyramid in pyramids.values():
+		pyramid.close()
+	return report
+
+
+def benchmark(file_input, num_frames, level=None, stack=None):
+	""" Encodes a sample of the session with every preset into a scratch
+	 directory and reports frames/s and bytes/frame for each """
+
+	names = sorted((name for name in os.listdir(file_input)
+		if os.path.splitext(name)[1].lower() == RAW_EXT), key = frame_key)
+	if not names:
+		raise RuntimeError('No raw frames found in "' + file_input + '"')
+	step = max(1, len(names) // num_frames)
+	shape, dtype = frame_format(file_input)
+	imgs = [read_raw(os.path.join(file_input, name), shape, dtype) for name in names[::step][:num_frames]]
+
+	results = {}
+	with tempfile.TemporaryDirectory() as scratch:
+		for name in sorted(ENCODERS):
+			encoder = get_encoder(name,
+				level if ENCODERS[name]['ext'] == '.png' else None,
+				stack if 'stack' in ENCODERS[name] else None)
+			size = encoder.get('stack', 1)
+			batches = [imgs[i:i + size] for i in range(0, len(imgs), size)]
+			num_bytes = 0
+			start = time.perf_counter()
+			for i, batch in enumerate(batches):
+				dst = os.path.join(scratch, name + str(i) + encoder['ext'])
+				write_frames(batch, dst, encoder)
+				num_bytes += os.path.getsize(dst)
+			elapsed = time.perf_counter() - start
+			results[name] = {'fps': len(imgs) / elapsed, 'bytes_per_frame': num_bytes / len(imgs)}
+
+	print('Benchmarked %d frames' % len(imgs))
+	print('%-12s %12s %16s' % ('encoder', 'frames/s', 'bytes/frame'))
+	for name, result in sorted(results.items(), key = lambda item: -item[1]['fps']):
+		print('%-12s %12.1f %16.0f' % (name, result['fps'], result['bytes_per_frame']))
+	return results
+
+
+def stack_paths(file_output, key):
+	""" Returns the frame stack, frame id and timestamp paths for a group """
+
+	base = os.path.join(file_output, key or 'frames')
+	return base + NPY_EXT, base + '_frame_ids' + NPY_EXT, base + '_timestamps' + NPY_EXT
+
+
+def export_stacks(file_input, file_output, preview=False):
+	""" Writes every group of per-frame files into a single (T, H, W) .npy so
+	 it can be opened with np.load(mmap_mode='r'). Each stack gets a frame id
+	 array and a timestamp array aligned to axis 0, and optionally a preview
+	 pyramid next to it. Timestamps are the camera's Timestamp chunk (ns)
+	 from the frames.csv sidecar, or the host write time (ns) for frames
+	 recorded without one """
+
+	groups, skipped = list_frames(file_input, (RAW_EXT, NPY_EXT))
+	shape, dtype = frame_format(file_input)
+	os.makedirs(file_output, exist_ok = True)
+	sidecar = read_frames(file_input)
+	camera_timestamps = {}
+	if sidecar is not None and sidecar.dtype.names is not None and 'timestamp' in sidecar.dtype.names:
+		camera_timestamps = dict(zip(sidecar['frame_id'].tolist(), sidecar['timestamp'].tolist()))
+
+	report = {'converted': 0, 'skipped': len(skipped), 'failed': 0, 'failures': []}
+	for key, names in sorted(groups.items()):
+		srcs = [os.path.join(file_input, name) for name in names]
+		stack_path, ids_path, ts_path = stack_paths(file_output, key)
+		print('Exporting %d frames to %s' % (len(srcs), stack_path))
+
+		# The frame format comes from the metadata, so a bad first frame
+		# fails like any other
+		stack = np.lib.format.open_memmap(stack_path, mode = 'w+', dtype = dtype,
+			shape = (len(srcs),) + tuple(shape))
+		frame_ids = np.full(len(srcs), -1, dtype = np.int64)
+		timestamps = np.zeros(len(srcs), dtype = np.int64)
+		valid = np.zeros(len(srcs), dtype = bool)
+		pyramid = PyramidWriter(stack_path[:-len(NPY_EXT)] + '_preview') if preview else None
+		for i, src in enumerate(tqdm(srcs)):
+			try:
+				stack[i] = read_raw(src, shape, dtype)
+			except (OSError, ValueError) as e:
+				report['failed'] += 1
+				report['failures'].append((src, str(e)))
+				continue
+			frame_ids[i] = frame_key(names[i])[1]
+			timestamps[i] = camera_timestamps.get(frame_ids[i], os.stat(src).st_mtime_ns)
+			valid[i] = True
+			if pyramid is not None:
+				pyramid.add(stack[i], frame_ids[i], src)
+		stack.flush()
+		del stack
+		if pyramid is not None:
+			pyramid.close()
+
+		np.save(ids_path, frame_ids)
+		np.save(ts_path, timestamps)
+		report['converted'] += int(valid.sum())
+
+	return report
+
+
+def load_stack(file_output, key=''):
+	""" Opens an exported stack memory mapped. Returns the (T, H, W) frames
+	 with their frame ids and timestamps, failed frames have id -1 """
+
+	stack_path, ids_path, ts_path = stack_paths(file_output, key)
+	return np.load(stack_path, mmap_mode = 'r'), np.load(ids_path), np.load(ts_path)
+
+
+def print_report(report):
+	print('Converted: %d  Skipped: %d  Failed: %d' % (report['converted'], report['skipped'], report['failed']))
+	for src, reason in report['failures']:
+		print('FAILED: ' + src + ' (' + reason + ')')
+
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	if args.benchmark:
+		benchmark(args.input, args.benchmark, args.level, args.stack)
+		raise SystemExit
+	if args.export_stack:
+		print_report(export_stacks(args.input, args.output, args.preview))
+		raise SystemExit
+	encoder = get_encoder(args.encoder, args.level, args.stack)
+	plan = build_plan(args.input, args.output, encoder, overwrite = args.overwrite)
+	print('Planned %d frames into %d directories' % (len(plan['jobs']), len(plan['dirs'])))
+	report = run_plan(plan, args.preview)
+	print_report(report)
@@ -1,5 +1,6 @@
 from pyspin import PySpin
-from camera import Camera
+from rig import Rig, find_configs
+from tasks import load_task, task_configs, DEFAULT_TASK
 from multiprocessing import Process
 import png
 import argparse
@@ -8,22 +9,23 @@ import numpy as np
 parser = argparse.ArgumentParser(description='Process Camera Inputs.')
 
 
-parser.add_argument('--task', metavar = 'task', type = str, default = 'open-field')
-parser.add_argument('--fps', metavar = 'fps', type = int, default = 100)
-parser.add_argument('--time', metavar = 'time', type = float, default = 600)
+parser.add_argument('--task', metavar = 'task', type = str, default = DEFAULT_TASK)
+parser.add_argument('--fps', metavar = 'fps', type = int, default = None)
+parser.add_argument('--time', metavar = 'time', type = float, default = None)
 
 
 args = parser.parse_args()
+# The task picks the cameras, their overrides and the frame rate, and is
+# validated before the system instance is taken
+task = load_task(args.task)
+configs = task_configs(task, find_configs(), args.fps)
+NUM_IMAGES = int((args.fps or task['fps']) * (args.time or task['time']))
 
 
 
 system = PySpin.System.GetInstance()
 
 
-side = Camera('20400920', True, system, 'side', 'side.yaml')
-bottom = Camera('20400910', False, system, 'bottom', 'bottom.yaml')
-top = Camera('20400913', False, system, 'top', 'top.yaml')
-
 def record(n = 10000):
 		while n:
 			side.stream_buffer.put(np.asarray(side.cam.GetNextImage))
@@ -45,12 +47,17 @@ def save():
 		png.from_array(image_converted).save(filename)
 
 
-bottom.start_aquisition()
-top.start_aquisition()
-side.start_aquisition()
-
-side_save = Process(target=save)
-side_save.daemon = True
-#side_intake = Process(target=side.record)
-record()
-side_save.start() 
\ No newline at end of file
+# The rig stops and releases every camera and the system instance on the
+# way out, also on errors and Ctrl-C
+with Rig(system, configs) as rig:
+	cameras = rig.init_cameras()
+	# Secondaries first, so they catch the primary's first trigger
+	for camera in sorted(cameras, key = lambda camera: camera.primary):
+		camera.start_aquisition()
+	side = next(camera for camera in cameras if camera.primary)
+
+	side_save = Process(target=save)
+	side_save.daemon = True
+	#side_intake = Process(target=side.record)
+	record(NUM_IMAGES)
+	side_save.start() 
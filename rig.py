@@ -0,0 +1,121 @@
+from camera import init_cameras
+from utils import load_config
+
+import os
+import glob
+
+CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def find_configs(config_dir=CONFIG_DIR):
+	""" Returns the compiled camera configs in config_dir, i.e. every yaml
+	 file with a "serial" key """
+
+	configs = [load_config(yaml_path) for yaml_path in sorted(glob.glob(os.path.join(config_dir, '*.yaml')))]
+	return [config for config in configs if config.serial is not None]
+
+
+class Rig:
+	def __init__(self, system, configs=None, triggered=True):
+
+		"""
+		Enumerates the cameras on the bus once and matches each camera
+		config to its camera by serial. configs defaults to find_configs().
+		Every config is validated before any camera is touched. The rig
+		owns system: close(), leaving a with block or a failure here
+		releases it. A triggered rig needs exactly one primary; with
+		triggered=False the cameras free run, any subset of the configs
+		can be used and init_cameras never arms the triggers
+		"""
+		self.system = system
+		self.triggered = triggered
+		self.cameras = []
+		self.devices = {}
+		self.cam_list = None
+		try:
+			self._match(configs)
+		except BaseException:
+			self.close()
+			raise
+
+	def _match(self, configs):
+		self.configs = find_configs() if configs is None else \
+			[load_config(config) if isinstance(config, str) else config for config in configs]
+		if not self.configs:
+			raise RuntimeError('No camera configs found')
+
+		names = [config.name for config in self.configs]
+		serials = [config.serial for config in self.configs]
+		if len(set(names)) != len(names) or len(set(serials)) != len(serials):
+			raise RuntimeError('Camera names and serials must be unique, got: ' + str(list(zip(names, serials))))
+		if self.triggered and sum(config.primary for config in self.configs) != 1:
+			raise RuntimeError('Exactly one camera must have role: primary, got: ' +
+				str([config.name for config in self.configs if config.primary]))
+
+		self.cam_list = self.system.GetCameras()
+		for i in range(self.cam_list.GetSize()):
+			cam = self.cam_list.GetByIndex(i)
+			self.devices[str(cam.TLDevice.DeviceSerialNumber.GetValue())] = cam
+		cam = None
+
+		missing = [config.name + ' (' + config.serial + ')' for config in self.configs if config.serial not in self.devices]
+		if missing:
+			raise RuntimeError('Cameras not found: ' + ', '.join(missing) + '. Connected: ' + ', '.join(sorted(self.devices)))
+		for serial in sorted(set(self.devices) - set(serials)):
+			print('Ignoring camera ' + serial + ', it has no config')
+
+	def init_cameras(self, user_set=None, arm=True):
+		""" Initializes and configures every camera in parallel, see
+		 camera.init_cameras. Returns the cameras in config order """
+
+		self.cameras = init_cameras([(self.devices[config.serial], config) for config in self.configs], user_set,
+			arm and self.triggered)
+		return self.cameras
+
+	def release(self):
+		""" Drops every camera reference and clears the camera list so the
+		 system instance can be released """
+
+		self.cameras = []
+		self.devices = {}
+		if self.cam_list is not None:
+			self.cam_list.Clear()
+
+	def close(self):
+		""" Stops and deinitializes every camera, including ones left
+		 initialized by a failed startup, then releases the camera list and
+		 the system instance. Idempotent, and every step runs even if an
+		 earlier one fails: failures are printed rather than raised so they
+		 never hide the error that caused the teardown """
+
+		if self.system is None:
+			return
+		for camera in self.cameras:
+			try:
+				camera.release()
+			except Exception as error:
+				print('WARNING: releasing camera failed: ' + str(error))
+		for cam in self.devices.values():
+			try:
+				if cam.IsInitialized():
+					cam.DeInit()
+			except Exception as error:
+				print('WARNING: releasing camera failed: ' + str(error))
+		cam = None  # Spinnaker refuses to release the system while references remain
+		self.release()
+		self.system.ReleaseInstance()
+		self.system = None
+		print('Cameras released')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+		return False
+
+	def __getitem__(self, name):
+		for camera in self.cameras:
+			if camera.cam_name == name:
+				return camera
+		raise KeyError(name)
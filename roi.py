@@ -0,0 +1,75 @@
+import argparse
+import cv2
+import numpy as np
+from utils import load_config, roi_nodes, check_roi, SENSOR_WIDTH, SENSOR_HEIGHT
+
+
+def write_roi(yaml_path, roi):
+	""" Replaces the "roi" section of a camera yaml file, or removes it if
+	 roi is None. The file is edited as text so the rest of it, including
+	 comments and layout, is left as is. The new config is compiled first so
+	 an invalid roi never reaches the file """
+
+	with open(yaml_path) as file:
+		lines = file.read().splitlines()
+
+	# Drop the current section: the "roi:" line and everything indented below it
+	kept = []
+	in_roi = False
+	for line in lines:
+		if line.startswith('roi:'):
+			in_roi = True
+			continue
+		if in_roi and (line.startswith((' ', '\t')) or not line.strip()):
+			continue
+		in_roi = False
+		kept.append(line)
+
+	if roi is not None:
+		check_roi(yaml_path, roi)
+		section = ['roi:'] + ['    ' + key + ': ' + str(roi[key])
+			for key in ('x', 'y', 'width', 'height', 'binning', 'decimation') if key in roi]
+		at = next((i for i, line in enumerate(kept) if line.startswith('init:')), len(kept))
+		kept[at:at] = section
+
+	with open(yaml_path, 'w') as file:
+		file.write('\n'.join(kept) + '\n')
+	return load_config(yaml_path)
+
+
+def select_roi(frame):
+	""" Lets the user drag the arena rectangle on a calibration frame.
+	 Returns {x, y, width, height} in sensor pixels, or None if cancelled """
+
+	x, y, width, height = cv2.selectROI('Select arena, then press enter', frame, showCrosshair = False)
+	cv2.destroyAllWindows()
+	if width == 0 or height == 0:
+		return None
+	return {'x': int(x), 'y': int(y), 'width': int(width), 'height': int(height)}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Sets the arena ROI of a camera yaml file.')
+	parser.add_argument('yaml', type = str)
+	parser.add_argument('--frame', type = str, default = None,
+		help = 'Full frame Mono8 .Raw calibration frame to draw the ROI on')
+	parser.add_argument('--rect', type = int, nargs = 4, metavar = ('x', 'y', 'width', 'height'), default = None)
+	parser.add_argument('--binning', type = int, default = 1)
+	parser.add_argument('--clear', action = 'store_true', help = 'Remove the ROI, recording full frame')
+	args = parser.parse_args()
+
+	if args.clear:
+		roi = None
+	elif args.rect is not None:
+		roi = dict(zip(('x', 'y', 'width', 'height'), args.rect))
+	elif args.frame is not None:
+		roi = select_roi(np.fromfile(args.frame, dtype = np.uint8).reshape(SENSOR_HEIGHT, SENSOR_WIDTH))
+		if roi is None:
+			raise SystemExit('No ROI selected')
+	else:
+		raise SystemExit('Give --frame, --rect or --clear')
+	if roi is not None and args.binning != 1:
+		roi['binning'] = args.binning
+
+	config = write_roi(args.yaml, roi)
+	print(args.yaml + ': ' + ('full frame' if config.roi is None else str(roi_nodes(config.roi))))
@@ -0,0 +1,25 @@
+# Selector each selector dependent node is read and written through. Plain
+# data without PySpin, shared by utils and the fake camera
+SELECTORS = {
+	'Gain': 'GainSelector',
+	'BlackLevel': 'BlackLevelSelector',
+	'V3_3Enable': 'LineSelector',
+	'LineSource': 'LineSelector',
+	'LineMode': 'LineSelector',
+	'LineInverter': 'LineSelector',
+	'UserOutputValue': 'UserOutputSelector',
+	'TriggerMode': 'TriggerSelector',
+	'TriggerSource': 'TriggerSelector',
+	'TriggerActivation': 'TriggerSelector',
+	'TriggerOverlap': 'TriggerSelector',
+	'TriggerDelay': 'TriggerSelector',
+	'SequencerTriggerSource': 'SequencerSetSelector',
+	'SequencerSetNext': 'SequencerSetSelector',
+	'ChunkEnable': 'ChunkSelector',
+	'EventNotification': 'EventSelector',
+	'CounterEventSource': 'CounterSelector',
+	'CounterDuration': 'CounterSelector',
+	'CounterDelay': 'CounterSelector',
+	'CounterTriggerSource': 'CounterSelector',
+	'CounterTriggerActivation': 'CounterSelector',
+}
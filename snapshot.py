@@ -0,0 +1,138 @@
+import PySpin
+import argparse
+import gzip
+import json
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import SELECTORS, load_config
+
+SNAPSHOT_FILE = 'nodemap.json.gz'
+
+# Node types that hold a value, category and command nodes are skipped
+VALUE_TYPES = (PySpin.intfIString, PySpin.intfIInteger, PySpin.intfIFloat,
+	PySpin.intfIBoolean, PySpin.intfIEnumeration)
+
+
+def dump_nodemap(nodemap):
+	""" Returns {node name: value string} for every readable value node.
+	 Walks the flat node list instead of recursing through the categories
+	 like the NodeMapInfo example, and reads every type through ToString().
+	 Selector dependent nodes are read for the current selector only """
+
+	values = {}
+	for node in nodemap.GetNodes():
+		if node.GetPrincipalInterfaceType() not in VALUE_TYPES:
+			continue
+		if not PySpin.IsAvailable(node) or not PySpin.IsReadable(node):
+			continue
+		try:
+			values[node.GetName()] = PySpin.CValuePtr(node).ToString()
+		except PySpin.SpinnakerException:
+			continue
+	return values
+
+
+def take_snapshot(cam, path, name=''):
+	""" Dumps the device, stream and camera nodemaps of an initialized camera
+	 to a gzipped json file. Returns the time it took in seconds """
+
+	start = time.perf_counter()
+	snapshot = {
+		'name': name,
+		'serial': cam.GetUniqueID(),
+		'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+		'nodes': {
+			'device': dump_nodemap(cam.GetTLDeviceNodeMap()),
+			'stream': dump_nodemap(cam.GetTLStreamNodeMap()),
+			'camera': dump_nodemap(cam.GetNodeMap()),
+		},
+	}
+	with gzip.open(path, 'wt') as file:
+		json.dump(snapshot, file, separators = (',', ':'))
+	return time.perf_counter() - start
+
+
+def snapshot_cameras(cameras, save_dirs):
+	""" Snapshots every Camera into SNAPSHOT_FILE in its save directory,
+	 save_dirs is keyed by serial. Cameras are dumped in parallel """
+
+	with ThreadPoolExecutor(max_workers = len(cameras)) as executor:
+		futures = {camera.cam_name: executor.submit(take_snapshot, camera.cam,
+			os.path.join(save_dirs[camera.serial], SNAPSHOT_FILE), camera.cam_name) for camera in cameras}
+		for cam_name, future in futures.items():
+			print(cam_name + ' nodemap snapshot took %.3f s' % future.result())
+
+
+def load_snapshot(path):
+	with gzip.open(path, 'rt') as file:
+		return json.load(file)
+
+
+def _values_equal(a, b):
+	""" Compares two node value strings, numbers numerically and booleans
+	 whether they are written 1/0 or true/false """
+
+	a, b = str(a).strip(), str(b).strip()
+	if a == b:
+		return True
+	truth = {'1': True, 'true': True, '0': False, 'false': False}
+	if a.lower() in truth and b.lower() in truth:
+		return truth[a.lower()] == truth[b.lower()]
+	try:
+		return math.isclose(float(a), float(b), rel_tol = 1e-3)
+	except ValueError:
+		return False
+
+
+def diff_snapshots(a, b):
+	""" Returns (nodemap, node, value in a, value in b) for every node that
+	 differs between two snapshots, None where a node is missing """
+
+	diffs = []
+	for nodemap in sorted(set(a['nodes']) | set(b['nodes'])):
+		nodes_a = a['nodes'].get(nodemap, {})
+		nodes_b = b['nodes'].get(nodemap, {})
+		for node in sorted(set(nodes_a) | set(nodes_b)):
+			value_a, value_b = nodes_a.get(node), nodes_b.get(node)
+			if value_a is None or value_b is None or not _values_equal(value_a, value_b):
+				diffs.append((nodemap, node, value_a, value_b))
+	return diffs
+
+
+def diff_config(snapshot, config):
+	""" Returns (node, value in snapshot, value in config) for every node
+	 whose final value in a CameraConfig (roi, chunks, events and overrides
+	 included) differs from the snapshot. Enumeration values like
+	 PySpin.TriggerMode_On are compared by their entry name (On). The
+	 snapshot only holds selector dependent nodes for the selector entry
+	 current when it was taken, so values written under other entries
+	 (e.g. ChunkEnable for the other chunks) are not compared """
+
+	nodes = snapshot['nodes']['camera']
+	diffs = []
+	for (node, selector_entry), value in config.scoped_values.items():
+		if selector_entry is not None and not _values_equal(nodes.get(SELECTORS[node]), selector_entry):
+			continue
+		if node not in nodes or not _values_equal(nodes[node], value):
+			diffs.append((node, nodes.get(node), value))
+	return diffs
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compares a nodemap snapshot against another snapshot or a camera yaml.')
+	parser.add_argument('snapshot', type = str)
+	parser.add_argument('other', type = str, help = 'Snapshot or camera yaml file')
+	args = parser.parse_args()
+
+	snapshot = load_snapshot(args.snapshot)
+	if args.other.endswith('.yaml'):
+		diffs = diff_config(snapshot, load_config(args.other))
+		for node, actual, wanted in diffs:
+			print('%-32s camera: %-20s yaml: %s' % (node, actual, wanted))
+	else:
+		diffs = diff_snapshots(snapshot, load_snapshot(args.other))
+		for nodemap, node, value_a, value_b in diffs:
+			print('%-8s %-32s %-20s %s' % (nodemap, node, value_a, value_b))
+	print(str(len(diffs)) + ' difference(s)')
@@ -0,0 +1,126 @@
+import argparse
+
+from utils import SENSOR_WIDTH, SENSOR_HEIGHT
+
+# Sensor model for the rig's 1440x1080 global shutter cameras (Sony IMX273,
+# 226 fps at full frame). Readout time scales with the number of rows read.
+SENSOR_MAX_FPS = 226
+READOUT_OVERHEAD_ROWS = 20
+ROW_TIME_US = 1e6 / (SENSOR_MAX_FPS * (SENSOR_HEIGHT + READOUT_OVERHEAD_ROWS))
+# Minimum gap the camera needs between the end of an exposure and the next one
+EXPOSURE_OVERHEAD_US = 15
+
+# Default DeviceLinkThroughputLimit of a USB3 camera, in bytes/s
+LINK_LIMIT = 380000000
+
+PIXEL_BYTES = {
+	'Mono8': 1,
+	'Mono10Packed': 1.25,
+	'Mono12Packed': 1.5,
+	'Mono12p': 1.5,
+	'Mono16': 2,
+	'BayerRG8': 1,
+	'BayerRG16': 2,
+	'RGB8': 3,
+	'RGB8Packed': 3,
+}
+
+
+def readout_us(height):
+	""" Sensor readout time of one frame of the given height """
+
+	return (height + READOUT_OVERHEAD_ROWS) * ROW_TIME_US
+
+
+def solve(width=SENSOR_WIDTH, height=SENSOR_HEIGHT, pixel_format='Mono8', exposure_us=None,
+		  overlap='ReadOut', fps=None, link_limit=LINK_LIMIT):
+	""" Works out the highest frame rate a camera can reach for the given ROI,
+	 pixel format, exposure and trigger overlap, limited by the sensor and by
+	 the USB link. With overlap 'Off' (triggered, no overlap) the next
+	 exposure only starts once readout is done, otherwise exposure of the
+	 next frame runs during readout of the last one. If fps is given the
+	 result also says whether that rate is feasible, and why not """
+
+	if pixel_format not in PIXEL_BYTES:
+		raise RuntimeError('Unknown pixel format "' + str(pixel_format) + '", known: ' + ', '.join(sorted(PIXEL_BYTES)))
+
+	bytes_per_frame = width * height * PIXEL_BYTES[pixel_format]
+	readout = readout_us(height)
+	exposure = exposure_us or 0
+	if overlap == 'Off':
+		period = exposure + EXPOSURE_OVERHEAD_US + readout
+	else:
+		period = max(exposure + EXPOSURE_OVERHEAD_US, readout)
+
+	result = {
+		'bytes_per_frame': bytes_per_frame,
+		'readout_us': readout,
+		'max_fps_sensor': 1e6 / period,
+		'max_fps_link': link_limit / bytes_per_frame,
+	}
+	result['max_fps'] = min(result['max_fps_sensor'], result['max_fps_link'])
+
+	if fps is not None:
+		result['fps'] = fps
+		result['bandwidth'] = bytes_per_frame * fps
+		result['max_exposure_us'] = 1e6 / fps - EXPOSURE_OVERHEAD_US - (readout if overlap == 'Off' else 0)
+		result['problems'] = []
+		if fps > result['max_fps_sensor']:
+			if exposure > result['max_exposure_us']:
+				result['problems'].append('exposure %.0f us is longer than the %.0f us a %g fps frame allows' %
+					(exposure, max(result['max_exposure_us'], 0), fps))
+			else:
+				result['problems'].append('sensor readout of %d rows limits the rate to %.1f fps' %
+					(height, result['max_fps_sensor']))
+		if fps > result['max_fps_link']:
+			result['problems'].append('%.0f MB/s exceeds the %.0f MB/s link limit (max %.1f fps)' %
+				(result['bandwidth'] / 1e6, link_limit / 1e6, result['max_fps_link']))
+		result['feasible'] = not result['problems']
+	return result
+
+
+def solve_config(config, fps, link_limit=LINK_LIMIT):
+	""" Runs solve on the ROI, pixel format, exposure and trigger overlap of a
+	 compiled CameraConfig. Free running cameras (no trigger) overlap
+	 exposure and readout """
+
+	overlap = 'ReadOut'
+	if config.enum_value('TriggerMode') == 'On':
+		overlap = config.enum_value('TriggerOverlap', 'Off')
+	# A sequencer runs every set in turn, the longest exposure must fit
+	exposures = [nodes['ExposureTime'] for nodes in config.sequencer if 'ExposureTime' in nodes]
+	exposure_us = max(exposures) if exposures else config.values.get('ExposureTime')
+	return solve(width = config.values.get('Width', SENSOR_WIDTH),
+				 height = config.values.get('Height', SENSOR_HEIGHT),
+				 pixel_format = config.enum_value('PixelFormat', 'Mono8'),
+				 exposure_us = exposure_us,
+				 overlap = overlap, fps = fps, link_limit = link_limit)
+
+
+def check_rig(configs, fps, link_limits=None):
+	""" Solves every camera config at the rig frame rate and prints a table.
+	 link_limits optionally maps serial to the camera's throughput limit.
+	 Returns {camera name: result} """
+
+	link_limits = link_limits or {}
+	results = {}
+	print('%-8s %10s %10s %10s %12s  %s' % ('camera', 'max fps', 'sensor', 'link', 'MB/s', 'status'))
+	for config in configs:
+		result = solve_config(config, fps, link_limits.get(config.serial, LINK_LIMIT))
+		results[config.name] = result
+		print('%-8s %10.1f %10.1f %10.1f %12.1f  %s' % (config.name, result['max_fps'], result['max_fps_sensor'],
+			result['max_fps_link'], result['bandwidth'] / 1e6, 'ok' if result['feasible'] else '; '.join(result['problems'])))
+	return results
+
+
+if __name__ == '__main__':
+	from rig import find_configs
+
+	parser = argparse.ArgumentParser(description='Checks the camera configs can run at a frame rate.')
+	parser.add_argument('--fps', metavar = 'fps', type = float, default = 200)
+	args = parser.parse_args()
+
+	configs = [config.with_overrides({'AcquisitionFrameRate': args.fps}) for config in find_configs()]
+	results = check_rig(configs, args.fps)
+	if not all(result['feasible'] for result in results.values()):
+		raise SystemExit(1)
@@ -0,0 +1,147 @@
+import argparse
+import copy
+import json
+import os
+import time
+import yaml
+
+TASKS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tasks.yaml')
+# The resolved profile of a recording, written next to its camera directories
+TASK_FILE = 'task.json'
+DEFAULT_TASK = 'open-field'
+# How the recorder writes frames: file extension and the compression levels
+# accepted (zlib level for png, libtiff scheme for tiff, e.g. 1 none, 5 LZW)
+BACKENDS = {
+	'raw': {'ext': '.Raw', 'compression': (None,)},
+	'png': {'ext': '.png', 'compression': tuple(range(10))},
+	'tiff': {'ext': '.tiff', 'compression': (1, 5, 8)},
+}
+# Profile keys and their defaults. cameras None records every camera config
+DEFAULTS = {
+	'cameras': None,
+	'fps': 200,
+	'time': 300,
+	'overrides': {},
+	'roi': {},
+	'backend': 'raw',
+	'compression': None,
+}
+
+
+def _check_task(name, task):
+	""" Validates one profile of tasks.yaml and fills in the defaults """
+
+	if not isinstance(task, dict) or set(task) - set(DEFAULTS):
+		raise RuntimeError('Task "' + name + '" must be a mapping of ' + str(list(DEFAULTS)) + ', got: ' + str(task))
+	task = dict(copy.deepcopy(DEFAULTS), **task)
+	if task['cameras'] is not None and (not isinstance(task['cameras'], list) or not task['cameras'] or
+			not all(isinstance(camera, str) for camera in task['cameras'])):
+		raise RuntimeError('"cameras" of task "' + name + '" must be a list of camera names, got: ' + str(task['cameras']))
+	for key in ('fps', 'time'):
+		if not isinstance(task[key], (int, float)) or task[key] <= 0:
+			raise RuntimeError('"' + key + '" of task "' + name + '" must be a positive number, got: ' + str(task[key]))
+	for key in ('overrides', 'roi'):
+		if not isinstance(task[key], dict):
+			raise RuntimeError('"' + key + '" of task "' + name + '" must map camera names, got: ' + str(task[key]))
+	if any(not isinstance(overrides, dict) for overrides in task['overrides'].values()):
+		raise RuntimeError('"overrides" of task "' + name + '" must map camera names to {node: value}')
+	if task['backend'] not in BACKENDS:
+		raise RuntimeError('"backend" of task "' + name + '" must be one of ' + str(sorted(BACKENDS)) +
+			', got: ' + str(task['backend']))
+	if task['compression'] is None:
+		task['compression'] = BACKENDS[task['backend']]['compression'][0]
+	if task['compression'] not in BACKENDS[task['backend']]['compression']:
+		raise RuntimeError('"compression" of task "' + name + '" must be one of ' +
+			str(BACKENDS[task['backend']]['compression']) + ' for ' + task['backend'] + ', got: ' + str(task['compression']))
+	task['name'] = name
+	return task
+
+
+def load_tasks(path=TASKS_FILE):
+	""" Returns every validated task profile in tasks.yaml, by name """
+
+	with open(path) as file:
+		tasks = yaml.safe_load(file)
+	if not isinstance(tasks, dict) or not tasks:
+		raise RuntimeError('"' + path + '" must map task names to profiles')
+	return {str(name): _check_task(str(name), task) for name, task in tasks.items()}
+
+
+def load_task(name=DEFAULT_TASK, path=TASKS_FILE):
+	tasks = load_tasks(path)
+	if name not in tasks:
+		raise RuntimeError('Unknown task "' + name + '", the tasks are: ' + ', '.join(tasks))
+	return tasks[name]
+
+
+def task_configs(task, configs, fps=None):
+	""" Picks the camera configs a task records out of configs and applies
+	 its ROIs and node overrides, with AcquisitionFrameRate set to fps (the
+	 task's by default). Every camera named by the task must exist and
+	 exactly one of them must be the primary """
+
+	by_name = {config.name: config for config in configs}
+	names = task['cameras'] or list(by_name)
+	unknown = [name for name in names + list(task['overrides']) + list(task['roi']) if name not in by_name]
+	if unknown:
+		raise RuntimeError('Task "' + task['name'] + '" names unknown cameras ' + str(sorted(set(unknown))) +
+			', the configs are: ' + ', '.join(by_name))
+	unused = [name for name in list(task['overrides']) + list(task['roi']) if name not in names]
+	if unused:
+		raise RuntimeError('Task "' + task['name'] + '" configures cameras it does not record: ' + str(sorted(set(unused))))
+
+	selected = []
+	for name in names:
+		config = by_name[name]
+		if name in task['roi']:
+			config = config.with_roi(task['roi'][name])
+		overrides = dict(task['overrides'].get(name, {}), AcquisitionFrameRate = fps or task['fps'])
+		selected.append(config.with_overrides(overrides))
+	if sum(config.primary for config in selected) != 1:
+		raise RuntimeError('Task "' + task['name'] + '" must record exactly one primary camera, got: ' +
+			str([config.name for config in selected if config.primary]))
+	return selected
+
+
+def save_task(save_root, task, fps, cameras=None):
+	""" Records a session's task next to its camera directories, with the
+	 frame rate and the names of the cameras actually recorded """
+
+	with open(os.path.join(save_root, TASK_FILE), 'w') as file:
+		json.dump(dict(task, fps = fps, cameras = cameras or task['cameras']), file, indent = 1)
+
+
+def session_dir(data_root, task):
+	""" Directory of a new recording of task under data_root, named after
+	 the task and the start time so no two recordings share one """
+
+	return os.path.join(data_root, task['name'] + time.strftime('_%Y-%m-%d_%H-%M-%S'))
+
+
+def read_task(session_dir):
+	""" Returns the task recorded with a session, or None if it has none """
+
+	path = os.path.join(session_dir, TASK_FILE)
+	if not os.path.isfile(path):
+		return None
+	with open(path) as file:
+		return json.load(file)
+
+
+if __name__ == '__main__':
+	from rig import find_configs
+	from solver import check_rig
+
+	parser = argparse.ArgumentParser(description='Lists the task profiles, or checks one can be recorded.')
+	parser.add_argument('task', type = str, nargs = '?', default = None)
+	args = parser.parse_args()
+
+	if args.task is None:
+		for task in load_tasks().values():
+			print('%-16s %s, %g fps, %g s, %s' % (task['name'], ', '.join(task['cameras'] or ['all cameras']),
+				task['fps'], task['time'], task['backend']))
+	else:
+		task = load_task(args.task)
+		results = check_rig(task_configs(task, find_configs()), task['fps'])
+		if not all(result['feasible'] for result in results.values()):
+			raise SystemExit(1)
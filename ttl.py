@@ -0,0 +1,189 @@
+import argparse
+import os
+import numpy as np
+from metadata import read_frames, read_metadata
+from frameset import FRAMESETS_FILE
+from clocksync import load_clock, to_host
+from integrity import session_cameras
+
+TTL_FILE = 'ttl_events.csv'
+EDGES = {1: 'rising', -1: 'falling'}
+
+
+def find_edges(frames, line):
+	""" Finds the edges of one input line in a camera's frames.csv, from the
+	 line status sampled at the end of every exposure. An edge lands on the
+	 first frame showing the new state, so pulses shorter than a frame
+	 period can be missed. Returns (row, edge, frames missing before it),
+	 edge 1 rising and -1 falling """
+
+	if 'line_status' not in frames.dtype.names:
+		raise RuntimeError('No line_status column in frames.csv, the camera needs "ttl_lines" in its yaml')
+	state = (frames['line_status'] >> line) & 1
+	rows = np.nonzero(np.diff(state))[0] + 1
+	edges = np.where(state[rows] == 1, 1, -1)
+	# Frames lost just before an edge make its frame uncertain
+	gaps = frames['frame_id'][rows] - frames['frame_id'][rows - 1] - 1
+	return rows, edges, gaps
+
+
+def read_framesets(session_dir, names):
+	""" Returns the frame id of every camera (columns, in names order) in
+	 every set (rows) of a session's framesets.csv, -1 where missing, or
+	 None if the session has none """
+
+	path = os.path.join(session_dir, FRAMESETS_FILE)
+	if not os.path.isfile(path):
+		return None
+	with open(path) as file:
+		columns = file.readline().strip().split(',')
+	sets = np.loadtxt(path, delimiter = ',', skiprows = 1, dtype = np.int64, ndmin = 2,
+					  usecols = range(columns.index('missing')))
+	return sets[:, [columns.index(name) for name in names]]
+
+
+def _lookup(sorted_values, values):
+	""" Positions of values in a sorted array, -1 where absent """
+
+	if len(sorted_values) == 0:
+		return np.full(len(values), -1)
+	positions = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+	return np.where(sorted_values[positions] == values, positions, -1)
+
+
+def _nearest(sorted_values, values):
+	""" Positions of the nearest value in a sorted array """
+
+	after = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+	before = np.maximum(after - 1, 0)
+	return np.where(np.abs(values - sorted_values[before]) <= np.abs(sorted_values[after] - values), before, after)
+
+
+def map_frames(source, frame_ids, frames, sets=None, fits=None, period=None):
+	""" Maps frames of the source camera, by frame id, to the rows of every
+	 camera's frames.csv (the index of the frame in its saved stack). Uses
+	 the session's frame sets if given, otherwise the nearest frame in host
+	 time, which needs every camera's clock fit. Returns {name: rows}, -1
+	 where a camera has no frame for that trigger """
+
+	names = list(frames)
+	rows = {}
+	if sets is not None:
+		column = names.index(source)
+		order = np.argsort(sets[:, column], kind = 'stable')
+		found = _lookup(sets[order, column], frame_ids)
+		for i, name in enumerate(names):
+			ids = np.where(found >= 0, sets[order[np.maximum(found, 0)], i], -1)
+			rows[name] = np.where(ids >= 0, _lookup(frames[name]['frame_id'], ids), -1)
+		return rows
+
+	if fits is None or not all(fits.values()):
+		raise RuntimeError('Frames can only be matched across cameras with ' + FRAMESETS_FILE + ' or clock fits')
+	source_rows = _lookup(frames[source]['frame_id'], frame_ids)
+	times = to_host(frames[source]['timestamp'][np.maximum(source_rows, 0)], fits[source])
+	for name in names:
+		host = to_host(frames[name]['timestamp'], fits[name])
+		nearest = _nearest(host, times)
+		close = np.abs(host[nearest] - times) <= period / 2
+		rows[name] = np.where((source_rows >= 0) & close, nearest, -1)
+	return rows
+
+
+def set_rows(frames):
+	""" For a camera running its sequencer, the set of every row of its
+	 frames.csv and the row's position in that set's own frames.csv """
+
+	sets = frames['sequencer_set']
+	positions = np.zeros(len(sets), dtype = np.int64)
+	for sequencer_set in np.unique(sets):
+		positions[sets == sequencer_set] = np.arange(np.count_nonzero(sets == sequencer_set))
+	return sets, positions
+
+
+def align_session(session_dir, fps=None):
+	""" Finds the TTL edges on every camera's "ttl_lines" (from its
+	 metadata.json) and maps each one to a frame of every camera. Writes
+	 them to session_dir/ttl_events.csv and returns them as a list of dicts """
+
+	cameras = session_cameras(session_dir)
+	frames, fits, lines = {}, {}, {}
+	for name, frame_dir in cameras.items():
+		frames[name] = read_frames(frame_dir)
+		fits[name] = load_clock(frame_dir)
+		metadata = read_metadata(frame_dir) or {}
+		fps = fps or metadata.get('fps')
+		lines[name] = metadata.get('ttl_lines') or []
+	if not any(lines.values()):
+		raise RuntimeError('No camera in "' + session_dir + '" records ttl_lines')
+	names = list(cameras)
+	sets = read_framesets(session_dir, names)
+	period = 1e9 / fps if fps else None
+
+	events = []
+	for source in names:
+		for line in lines[source]:
+			rows, edges, gaps = find_edges(frames[source], line)
+			frame_ids = frames[source]['frame_id'][rows]
+			mapped = map_frames(source, frame_ids, frames, sets, fits, period)
+			timestamps = frames[source]['timestamp'][rows] if 'timestamp' in frames[source].dtype.names else None
+			host = to_host(timestamps, fits[source]) if timestamps is not None and fits[source] else None
+			for i in range(len(rows)):
+				events.append({'camera': source, 'line': line, 'edge': EDGES[edges[i]], 'frame_id': int(frame_ids[i]),
+							   'timestamp': -1 if timestamps is None else int(timestamps[i]),
+							   'host_time': -1 if host is None else int(host[i]), 'gap': int(gaps[i]),
+							   'frames': {name: int(mapped[name][i]) for name in names}})
+	events.sort(key = lambda event: (event['host_time'], event['timestamp']))
+
+	# One column per camera holding the row of the event's frame in that
+	# camera's frames.csv. The frames of a camera running its sequencer are
+	# saved per set, so its column holds the row in the set's frames.csv
+	# and a <name>_set column the set
+	sequenced = {name: set_rows(frames[name]) for name in names if 'sequencer_set' in frames[name].dtype.names}
+	columns = ['camera', 'line', 'edge', 'frame_id', 'timestamp', 'host_time', 'gap']
+	camera_columns = []
+	for name in names:
+		camera_columns += [name, name + '_set'] if name in sequenced else [name]
+	with open(os.path.join(session_dir, TTL_FILE), 'w', newline = '') as file:
+		file.write(','.join(columns + camera_columns) + '\n')
+		for event in events:
+			row = [event[column] for column in columns]
+			for name in names:
+				frame_row = event['frames'][name]
+				if name not in sequenced:
+					row.append(frame_row)
+				elif frame_row < 0:
+					row += [-1, -1]
+				else:
+					row += [sequenced[name][1][frame_row], sequenced[name][0][frame_row]]
+			file.write(','.join(str(value) for value in row) + '\n')
+	return events
+
+
+def print_events(events):
+	""" Prints the edge count per line and the events that could not be
+	 placed on a frame of every camera """
+
+	counts = {}
+	for event in events:
+		key = (event['camera'], event['line'], event['edge'])
+		counts[key] = counts.get(key, 0) + 1
+	print('TTL events:')
+	for (camera, line, edge), count in sorted(counts.items()):
+		print('  %-8s line %d %-8s %6d' % (camera, line, edge, count))
+	uncertain = sum(1 for event in events if event['gap'])
+	if uncertain:
+		print('WARNING: %d events follow dropped frames, their frame may be late' % uncertain)
+	for name in (events[0]['frames'] if events else []):
+		unmatched = sum(1 for event in events if event['frames'][name] < 0)
+		if unmatched:
+			print('WARNING: %d events have no %s frame' % (unmatched, name))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Maps the TTL edges recorded on the cameras\' input lines to frames.')
+	parser.add_argument('session', type = str, help = 'Directory holding one directory per camera')
+	parser.add_argument('--fps', metavar = 'fps', type = float, default = None)
+	args = parser.parse_args()
+
+	print_events(align_session(args.session, args.fps))
+	print('Written to ' + os.path.join(args.session, TTL_FILE))
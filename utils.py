@@ -2,105 +2,643 @@ import yaml
 import PySpin
 #from pyspin import PySpin
 import os
+import hashlib
+import time
+import math
+import json
+import copy
+import threading
+from scopes import SELECTORS
 
-def setup_cam(cam, yaml_path):
-	""" This will setup (initialize + configure) input
-	 camera given a path to a yaml file 
-	 - Credit to https://github.com/justinblaber/multi_pyspin/blob/master/multi_pyspin.py"""
+# Compiled configs keyed by yaml path and the sha1 of the file contents
+_CONFIG_CACHE = {}
 
-	if not os.path.isfile(yaml_path):
-		raise RuntimeError('"' + yaml_path + '" could not be found!')
+# Sensor size and the increments the camera accepts for the ROI nodes
+SENSOR_WIDTH = 1440
+SENSOR_HEIGHT = 1080
+ROI_INCREMENTS = {'OffsetX': 4, 'OffsetY': 2, 'Width': 16, 'Height': 2}
+FULL_FRAME = {'x': 0, 'y': 0, 'width': SENSOR_WIDTH, 'height': SENSOR_HEIGHT}
 
-	# Print setup
-	print(cam.GetUniqueID() + ' - setting up...')
+# Which config hash was saved into which camera user set, keyed by camera
+USERSET_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usersets.json')
+# init_cameras warm starts every camera on its own thread, all sharing the cache
+_USERSET_LOCK = threading.Lock()
 
-	# Init camera
-	cam.Init()
+# Where the primary's trigger output comes from: its own exposure (the
+# exposure active signal) or a fixed rate pulse train from Counter0
+TRIGGER_SOURCES = ('exposure', 'counter')
+TRIGGER_DEFAULTS = {'source': 'exposure', 'duty_cycle': 0.5, 'phase': 0.0}
 
-	# Load yaml file and grab init commands
-	node_cmd_dicts = None
-	with open(yaml_path, 'rb') as file:
-		yaml_dict = yaml.load(file, Loader=yaml.SafeLoader)
-		# Get commands from "init"
-		if isinstance(yaml_dict, dict) and 'init' in yaml_dict:
-			node_cmd_dicts = yaml_dict['init']
-
-	# Perform node commands if they are provided
-	if isinstance(node_cmd_dicts, list):
-		# Iterate over commands
+# Chunk holding the state of every I/O line at the end of the exposure, one
+# bit per line, which TTL inputs are read from
+LINE_STATUS_CHUNK = 'ExposureEndLineStatusAll'
+LINES = (0, 1, 2, 3)
+# Chunk holding the sequencer set a frame was exposed with
+SEQUENCER_CHUNK = 'SequencerSetActive'
+# Nodes a sequencer set may not switch, every set must give frames of one size
+SEQUENCER_FIXED = ('Width', 'Height', 'OffsetX', 'OffsetY', 'BinningHorizontal', 'BinningVertical', 'PixelFormat')
+
+
+class CameraConfig:
+	def __init__(self, yaml_path: str, yaml_dict: dict, digest: str):
+
+		"""
+		Validated, compiled form of a camera yaml file. Node names are split
+		into attribute paths and "PySpin." arguments are resolved once, so
+		applying the config is a plain loop over ready-made commands
+		"""
+		self.yaml_path = yaml_path
+		self.yaml_dict = yaml_dict
+		self.digest = digest
+		self.serial = None
+		self.commands = []
+		# Final yaml value of every node, as written in the yaml
+		self.values = {}
+		# Final value of every (node, selector entry) with enumeration values
+		# as entry names, e.g. ChunkEnable per ChunkSelector entry. The entry
+		# is None for nodes without a selector (see SELECTORS)
+		self.scoped_values = {}
+
+		if not isinstance(yaml_dict, dict):
+			raise RuntimeError('"' + yaml_path + '" does not contain a yaml mapping')
+		if yaml_dict.get('serial') is not None:
+			self.serial = str(yaml_dict['serial'])
+		self.name = str(yaml_dict.get('name', os.path.splitext(os.path.basename(yaml_path))[0]))
+		self.role = yaml_dict.get('role', 'secondary')
+		if self.role not in ('primary', 'secondary'):
+			raise RuntimeError('"role" in "' + yaml_path + '" must be primary or secondary, got: ' + str(self.role))
+		self.primary = self.role == 'primary'
+		self.trigger = _check_trigger(yaml_path, yaml_dict.get('trigger'), self.primary)
+
+		node_cmd_dicts = yaml_dict.get('init') or []
+		if not isinstance(node_cmd_dicts, list):
+			raise RuntimeError('"init" in "' + yaml_path + '" must be a list of node commands')
+
+		# The ROI goes first so the frame rate and exposure are set for the
+		# final frame size. Without one the full frame is written, so an ROI
+		# left on the camera by another task or config is undone
+		self.roi = None
+		if yaml_dict.get('roi') is not None:
+			self.roi = check_roi(yaml_path, yaml_dict['roi'])
+		node_cmd_dicts = _roi_node_cmds(self.roi or FULL_FRAME) + node_cmd_dicts
+
+		# Chunk data rides along with every image, so per-frame values cost
+		# no extra reads
+		self.chunks = _check_entries(yaml_path, 'chunks', yaml_dict.get('chunks') or [], 'ChunkSelector_')
+		# Input lines carrying TTL events (e.g. trial starts), sampled into
+		# every frame through the line status chunk
+		self.ttl_lines = _check_lines(yaml_path, yaml_dict.get('ttl_lines') or [])
+		if self.ttl_lines and LINE_STATUS_CHUNK not in self.chunks:
+			self.chunks.append(LINE_STATUS_CHUNK)
+
+		# Node values the camera switches between on every frame, e.g.
+		# alternating exposures. Programmed after the trigger is armed (see
+		# Camera.arm_trigger), not with the other commands
+		self.sequencer = _check_sequencer(yaml_path, yaml_dict.get('sequencer'))
+		self.sequencer_config = None
+		if self.sequencer:
+			if SEQUENCER_CHUNK not in self.chunks:
+				self.chunks.append(SEQUENCER_CHUNK)
+			self.sequencer_config = CameraConfig(yaml_path, {'init': _sequencer_node_cmds(self.sequencer)}, None)
+		node_cmd_dicts = node_cmd_dicts + _chunk_node_cmds(self.chunks)
+
+		# Device events to notify the host of, e.g. ExposureEnd
+		self.events = _check_entries(yaml_path, 'events', yaml_dict.get('events') or [], 'EventSelector_')
+		node_cmd_dicts = node_cmd_dicts + _event_node_cmds(self.events)
+
+		selected = {}
 		for node_cmd_dict in node_cmd_dicts:
-			if isinstance(node_cmd_dict, dict):
-				# Get camera node string
-				cam_node_str = list(node_cmd_dict.keys())
-				if len(cam_node_str) == 1:
-					cam_node_str = cam_node_str[0]
-
-					# NOTE: I believe there should only be SetValue()'s and Execute()'s with RW access mode for
-					# initialization of camera (read only doesn't make sense and the write onlys that I've seen are
-					# mainly for rebooting the camera, which isn't necessary). If this is not the case, then the method
-					# and/or access mode(s) will need to be added to the yaml file.
-
-					# Get node argument (if it exists)
-					cam_node_arg = None
-					cam_node_dict = node_cmd_dict[cam_node_str]
-					if isinstance(cam_node_dict, dict) and 'value' in cam_node_dict:
-						cam_node_arg = cam_node_dict['value']
-
-					# Get method
-					if cam_node_arg is not None:
-						# Assume this is a SetValue()
-						cam_method_str = 'SetValue'
-					else:
-						# Assume this is an Execute()
-						cam_method_str = 'Execute'
-
-					# Get mode - Assume this is RW
-					pyspin_mode_str = 'RW'
-
-					# Perform command
-					_node_cmd(cam,
-							  cam_node_str,
-							  cam_method_str,
-							  pyspin_mode_str,
-							  cam_node_arg)
+			self.commands.append(_compile_node_cmd(yaml_path, node_cmd_dict))
+			cam_node_str, cam_node_path = self.commands[-1][:2]
+			cam_node_dict = list(node_cmd_dict.values())[0]
+			if isinstance(cam_node_dict, dict) and 'value' in cam_node_dict:
+				self.values[cam_node_str] = cam_node_dict['value']
+				entry = _entry_name(cam_node_str, cam_node_dict['value'])
+				if cam_node_path[-1].endswith('Selector'):
+					selected[cam_node_str] = entry
 				else:
-					raise RuntimeError('Only one camera node per yaml "tick" is supported. '
-									   'Please fix: ' + str(cam_node_str))
+					self.scoped_values[(cam_node_str, selected.get(SELECTORS.get(cam_node_str)))] = entry
+
+	def enum_value(self, cam_node_str, default=None):
+		""" Returns the entry name of an enumeration node's final value, e.g.
+		 "ReadOut" for PySpin.TriggerOverlap_ReadOut """
+
+		value = self.values.get(cam_node_str)
+		if value is None:
+			return default
+		return _entry_name(cam_node_str, value)
+
+	def frame_nodes(self):
+		""" OffsetX/OffsetY/Width/Height the config leaves the camera at, the
+		 full frame if it has no roi """
+
+		return roi_nodes(self.roi or FULL_FRAME)
 
+	def with_overrides(self, overrides: dict):
+		""" Returns a compiled copy of this config with the final value of
+		 each node in overrides replaced, or appended if the config doesn't
+		 set that node. The copy's digest covers the overrides """
 
+		yaml_dict = copy.deepcopy(self.yaml_dict)
+		node_cmd_dicts = yaml_dict.setdefault('init', [])
+		for cam_node_str, value in overrides.items():
+			last = None
+			for node_cmd_dict in node_cmd_dicts:
+				if isinstance(node_cmd_dict, dict) and cam_node_str in node_cmd_dict:
+					last = node_cmd_dict
+			if last is None:
+				node_cmd_dicts.append({cam_node_str: {'value': value}})
+			else:
+				last[cam_node_str] = {'value': value}
+		digest = hashlib.sha1((self.digest + json.dumps(overrides, sort_keys = True)).encode()).hexdigest()
+		return CameraConfig(self.yaml_path, yaml_dict, digest)
+
+	def with_roi(self, roi):
+		""" Returns a compiled copy of this config with its "roi" section
+		 replaced, or removed if roi is None """
+
+		yaml_dict = copy.deepcopy(self.yaml_dict)
+		yaml_dict.pop('roi', None)
+		if roi is not None:
+			yaml_dict['roi'] = roi
+		digest = hashlib.sha1((self.digest + 'roi' + json.dumps(roi, sort_keys = True)).encode()).hexdigest()
+		return CameraConfig(self.yaml_path, yaml_dict, digest)
+
+	def apply(self, cam, verbose=False, diff=True):
+		""" Runs the compiled commands on an initialized camera. With diff,
+		 only the writes that change the camera's current state are made
+		 (see plan). Returns the (node, old value, new value) changes """
+
+		if diff:
+			commands, changes = self.plan(cam)
+		else:
+			commands, changes = self.commands, [(command[0], None, command[3]) for command in self.commands]
+
+		for cam_node_str, cam_node_path, cam_method_str, cam_node_arg in commands:
+			if verbose:
+				print(cam.GetUniqueID() + ' - executing: "' + cam_node_str + '.' + cam_method_str + '(' +
+					  ('' if cam_node_arg is None else str(cam_node_arg)) + ')"')
+			cam_node = _get_node(cam, cam_node_path)
+			if cam_node_arg is None:
+				getattr(cam_node, cam_method_str)()
+			else:
+				getattr(cam_node, cam_method_str)(cam_node_arg)
+		return changes
 
-def _node_cmd(cam, cam_node_str, cam_method_str, pyspin_mode_str=None, cam_node_arg=None):
-	""" Performs method on input cam node with optional access mode check """
+	def plan(self, cam):
+		""" Reads the current value of every node the config writes and
+		 returns the minimal list of commands to reach the config, along
+		 with the (node, old value, new value) changes it makes.
 
-	# Print command info
-	info_str = cam.GetUniqueID() + ' - executing: "' + '.'.join([cam_node_str, cam_method_str]) + '('
-	if cam_node_arg is not None:
-		info_str += str(cam_node_arg)
-	print(info_str + ')"')
+		 Commands keep their yaml order, which encodes node dependencies:
+		 - a node scoped by a selector (see SELECTORS) is read and compared
+		   per entry of its own selector, any other node by name alone
+		 - selectors are kept whenever a kept command depends on them
+		 - a node written more than once (e.g. TriggerMode Off ... On) guards
+		   the commands in between and is kept if any of those are kept
+		 - Execute() commands and unreadable nodes are always kept
 
-	# Get camera node
+		 Reading a scoped node may switch its selector, every selector is
+		 put back to the value it had once the reads are done """
+
+		# Read pass: current value of every (node, own selector entry)
+		keys = []
+		current = {}
+		selected = {}
+		on_camera = {}
+		original = {}
+		try:
+			for cam_node_str, cam_node_path, cam_method_str, cam_node_arg in self.commands:
+				if cam_node_arg is None:
+					keys.append(None)
+					continue
+				if cam_node_path[-1].endswith('Selector'):
+					selected[cam_node_str] = cam_node_arg
+					keys.append(('selector', cam_node_str))
+					continue
+				selector = SELECTORS.get(cam_node_str)
+				key = (cam_node_str, selected.get(selector))
+				if key not in current:
+					if selector in selected:
+						if selector not in original:
+							original[selector] = on_camera[selector] = _read_node(cam, (selector,))
+						if not _node_equals(on_camera[selector], selected[selector]):
+							_get_node(cam, (selector,)).SetValue(selected[selector])
+							on_camera[selector] = selected[selector]
+					current[key] = _read_node(cam, cam_node_path)
+				keys.append(key)
+		finally:
+			for selector, value in original.items():
+				if value is not None and not _node_equals(on_camera[selector], value):
+					_get_node(cam, (selector,)).SetValue(value)
+
+		final = {}
+		positions = {}
+		for i, (key, command) in enumerate(zip(keys, self.commands)):
+			if key is not None and key[0] != 'selector':
+				final[key] = command[3]
+				positions.setdefault(key, []).append(i)
+		changed = set(key for key in final if not _node_equals(current[key], final[key]))
+
+		keep = [False] * len(self.commands)
+		for key, indices in positions.items():
+			if key in changed:
+				for i in indices:
+					keep[i] = True
+			elif len(indices) > 1 and any(keys[j] in changed and keys[j] != key
+										  for j in range(indices[0] + 1, indices[-1])):
+				for i in indices:
+					keep[i] = True
+		for i, key in enumerate(keys):
+			if key is None:
+				keep[i] = True
+
+		# Keep selectors that scope a kept command
+		for i in reversed(range(len(keys))):
+			if keys[i] is not None and keys[i][0] == 'selector':
+				for j in range(i + 1, len(keys)):
+					if keys[j] == keys[i]:
+						break
+					if keep[j] and keys[j] is not None and keys[j][0] != 'selector':
+						keep[i] = True
+						break
+
+		commands = [command for i, command in enumerate(self.commands) if keep[i]]
+		changes = [(key[0], current[key], final[key]) for key in final if key in changed]
+		return commands, changes
+
+
+def _get_node(cam, cam_node_path):
 	cam_node = cam
-	cam_node_str_split = cam_node_str.split('.')
-	for sub_cam_node_str in cam_node_str_split:
+	for sub_cam_node_str in cam_node_path:
 		cam_node = getattr(cam_node, sub_cam_node_str)
+	return cam_node
+
+
+def _read_node(cam, cam_node_path):
+	""" Returns the node's current value, or None if it can't be read """
+
+	try:
+		return _get_node(cam, cam_node_path).GetValue()
+	except Exception:
+		return None
+
+
+def _node_equals(current, target):
+	""" Compares a read back node value against a config value. The camera
+	 rounds floats (exposure, gain, frame rate) to its own increments, so
+	 those only need to match closely """
+
+	if current is None:
+		return False
+	if isinstance(current, float) or isinstance(target, float):
+		return math.isclose(current, target, rel_tol = 1e-3)
+	return current == target
+
+
+def check_roi(yaml_path, roi):
+	""" Validates a yaml "roi" section: x, y, width and height in full
+	 resolution sensor pixels, plus optional binning and decimation """
+
+	if not isinstance(roi, dict) or not all(key in roi for key in ('x', 'y', 'width', 'height')):
+		raise RuntimeError('"roi" in "' + yaml_path + '" needs x, y, width and height, got: ' + str(roi))
+	for key, value in roi.items():
+		if key not in ('x', 'y', 'width', 'height', 'binning', 'decimation'):
+			raise RuntimeError('Unknown "roi" key "' + str(key) + '" in "' + yaml_path + '"')
+		if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+			raise RuntimeError('"roi" ' + key + ' in "' + yaml_path + '" must be a non-negative integer')
+	for key in ('binning', 'decimation'):
+		if roi.get(key, 1) not in (1, 2, 4):
+			raise RuntimeError('"roi" ' + key + ' in "' + yaml_path + '" must be 1, 2 or 4')
+	if roi['x'] + roi['width'] > SENSOR_WIDTH or roi['y'] + roi['height'] > SENSOR_HEIGHT or \
+			roi['width'] == 0 or roi['height'] == 0:
+		raise RuntimeError('"roi" in "' + yaml_path + '" is empty or outside the ' +
+						   str(SENSOR_WIDTH) + 'x' + str(SENSOR_HEIGHT) + ' sensor')
+	return dict(roi)
+
+
+def roi_nodes(roi):
+	""" Converts an ROI in sensor pixels into OffsetX/OffsetY/Width/Height
+	 node values in binned/decimated pixels, shrunk to the node increments """
+
+	scale = roi.get('binning', 1) * roi.get('decimation', 1)
+	nodes = {
+		'OffsetX': roi['x'] // scale,
+		'OffsetY': roi['y'] // scale,
+		'Width': roi['width'] // scale,
+		'Height': roi['height'] // scale,
+	}
+	return {node: value - value % ROI_INCREMENTS[node] for node, value in nodes.items()}
+
+
+def _roi_node_cmds(roi):
+	""" Returns the "init" entries that apply an ROI. Offsets are zeroed
+	 first so the new width and height always fit. Binning and decimation
+	 not given by the roi are reset to 1 """
+
+	nodes = roi_nodes(roi)
+	node_cmd_dicts = [
+		{'OffsetX': {'value': 0}},
+		{'OffsetY': {'value': 0}},
+		{'BinningHorizontal': {'value': roi.get('binning', 1)}},
+		{'BinningVertical': {'value': roi.get('binning', 1)}},
+		{'DecimationHorizontal': {'value': roi.get('decimation', 1)}},
+		{'DecimationVertical': {'value': roi.get('decimation', 1)}},
+	]
+	return node_cmd_dicts + [{node: {'value': nodes[node]}} for node in ('Width', 'Height', 'OffsetX', 'OffsetY')]
+
+
+def _check_trigger(yaml_path, trigger, primary):
+	""" Validates the "trigger" section of the primary, e.g.
+		trigger:
+			source: counter
+			duty_cycle: 0.5
+			phase: 0.1
+	 duty_cycle is the fraction of the period the output is high, phase the
+	 fraction of the period the primary's own exposure lags the output's
+	 rising edge. Returns it with the defaults filled in """
+
+	if trigger is None:
+		return dict(TRIGGER_DEFAULTS)
+	if not isinstance(trigger, dict) or set(trigger) - set(TRIGGER_DEFAULTS):
+		raise RuntimeError('"trigger" in "' + yaml_path + '" must be a mapping of ' +
+			str(list(TRIGGER_DEFAULTS)) + ', got: ' + str(trigger))
+	trigger = dict(TRIGGER_DEFAULTS, **trigger)
+	if trigger['source'] not in TRIGGER_SOURCES:
+		raise RuntimeError('"trigger" source in "' + yaml_path + '" must be one of ' + str(TRIGGER_SOURCES) +
+			', got: ' + str(trigger['source']))
+	if trigger['source'] != 'exposure' and not primary:
+		raise RuntimeError('Only the primary generates the trigger, "' + yaml_path + '" is secondary')
+	if not 0 < trigger['duty_cycle'] < 1:
+		raise RuntimeError('"trigger" duty_cycle in "' + yaml_path + '" must be between 0 and 1, got: ' +
+			str(trigger['duty_cycle']))
+	if not 0 <= trigger['phase'] < 1:
+		raise RuntimeError('"trigger" phase in "' + yaml_path + '" must be in [0, 1), got: ' + str(trigger['phase']))
+	return trigger
+
+
+def _check_lines(yaml_path, lines):
+	""" Validates the "ttl_lines" list of line numbers """
+
+	if not isinstance(lines, list) or not all(line in LINES for line in lines) or len(set(lines)) != len(lines):
+		raise RuntimeError('"ttl_lines" in "' + yaml_path + '" must be a list of distinct lines out of ' +
+			str(list(LINES)) + ', got: ' + str(lines))
+	return list(lines)
+
 
-	# Perform optional access mode check
-	#if pyspin_mode_str is not None:
-		#if cam_node.GetAccessMode() != getattr(PySpin, pyspin_mode_str):
-		#	raise RuntimeError('Access mode check failed for: "' + cam_node_str + '" with mode: "' +
-		#					   pyspin_mode_str + '".')
+def _check_sequencer(yaml_path, sets):
+	""" Validates the "sequencer" section: a list of at least two sets, each
+	 mapping the same nodes to their value in that set, e.g.
+		sequencer:
+			- ExposureTime: 1000
+			  Gain: 0
+			- ExposureTime: 4000
+			  Gain: 10 """
+
+	if sets is None:
+		return []
+	if not isinstance(sets, list) or len(sets) < 2 or not all(isinstance(nodes, dict) and nodes for nodes in sets):
+		raise RuntimeError('"sequencer" in "' + yaml_path + '" must be a list of at least 2 sets of node values')
+	if any(set(nodes) != set(sets[0]) for nodes in sets):
+		raise RuntimeError('Every "sequencer" set in "' + yaml_path + '" must set the same nodes')
+	fixed = [node for node in sets[0] if node in SEQUENCER_FIXED]
+	if fixed:
+		raise RuntimeError('"sequencer" in "' + yaml_path + '" may not switch ' + str(fixed) +
+			', every set must give frames of the same size')
+	return [dict(nodes) for nodes in sets]
+
+
+def _sequencer_node_cmds(sets):
+	""" Returns the "init" entries that program the sequencer, as in the
+	 Sequencer example. Every frame start advances to the next set and the
+	 last set wraps around to the first. Starting it (SEQUENCER_ON) is left
+	 until the camera reports the configuration valid """
+
+	node_cmd_dicts = [
+		{'SequencerMode': {'value': 'PySpin.SequencerMode_Off'}},
+		{'ExposureAuto': {'value': 'PySpin.ExposureAuto_Off'}},
+		{'GainAuto': {'value': 'PySpin.GainAuto_Off'}},
+		{'SequencerConfigurationMode': {'value': 'PySpin.SequencerConfigurationMode_On'}},
+	]
+	for i, nodes in enumerate(sets):
+		node_cmd_dicts.append({'SequencerSetSelector': {'value': i}})
+		node_cmd_dicts += [{node: {'value': value}} for node, value in nodes.items()]
+		node_cmd_dicts += [
+			{'SequencerTriggerSource': {'value': 'PySpin.SequencerTriggerSource_FrameStart'}},
+			{'SequencerSetNext': {'value': (i + 1) % len(sets)}},
+			{'SequencerSetSave': None},
+		]
+	return node_cmd_dicts + [
+		{'SequencerConfigurationMode': {'value': 'PySpin.SequencerConfigurationMode_Off'}},
+	]
+
+
+def _check_entries(yaml_path, section, names, prefix):
+	""" Validates a yaml section listing selector entry names, e.g. the
+	 "chunks" section holds ChunkSelector entries such as Timestamp """
+
+	if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+		raise RuntimeError('"' + section + '" in "' + yaml_path + '" must be a list of names, got: ' + str(names))
+	for name in names:
+		if not hasattr(PySpin, prefix + name):
+			raise RuntimeError('Unknown ' + section + ' entry "' + name + '" in "' + yaml_path + '"')
+	if len(set(names)) != len(names):
+		raise RuntimeError('Duplicate ' + section + ' entries in "' + yaml_path + '": ' + str(names))
+	return list(names)
+
+
+def _chunk_node_cmds(chunks):
+	""" Returns the "init" entries that turn on chunk mode and enable each
+	 chunk, as in the ChunkData example """
+
+	if not chunks:
+		return []
+	node_cmd_dicts = [{'ChunkModeActive': {'value': True}}]
+	for chunk in chunks:
+		node_cmd_dicts += [
+			{'ChunkSelector': {'value': 'PySpin.ChunkSelector_' + chunk}},
+			{'ChunkEnable': {'value': True}},
+		]
+	return node_cmd_dicts
+
+
+def _event_node_cmds(events):
+	""" Returns the "init" entries that turn on notification of each device
+	 event, as in the DeviceEvents example """
+
+	node_cmd_dicts = []
+	for event in events:
+		node_cmd_dicts += [
+			{'EventSelector': {'value': 'PySpin.EventSelector_' + event}},
+			{'EventNotification': {'value': 'PySpin.EventNotification_On'}},
+		]
+	return node_cmd_dicts
+
+
+def _compile_node_cmd(yaml_path, node_cmd_dict):
+	""" Validates a single "init" entry and returns it as
+	 (node string, node attribute path, method, argument) """
+
+	# NOTE: I believe there should only be SetValue()'s and Execute()'s with RW access mode for
+	# initialization of camera (read only doesn't make sense and the write onlys that I've seen are
+	# mainly for rebooting the camera, which isn't necessary). If this is not the case, then the method
+	# and/or access mode(s) will need to be added to the yaml file.
+	if not isinstance(node_cmd_dict, dict) or len(node_cmd_dict) != 1:
+		raise RuntimeError('Only one camera node per yaml "tick" is supported. '
+						   'Please fix: ' + str(node_cmd_dict) + ' in "' + yaml_path + '"')
+
+	cam_node_str = list(node_cmd_dict.keys())[0]
+	cam_node_path = tuple(str(cam_node_str).split('.'))
+	if not all(sub_cam_node_str.isidentifier() for sub_cam_node_str in cam_node_path):
+		raise RuntimeError('Invalid camera node name: "' + str(cam_node_str) + '" in "' + yaml_path + '"')
+
+	# Get node argument (if it exists)
+	cam_node_arg = None
+	cam_node_dict = node_cmd_dict[cam_node_str]
+	if isinstance(cam_node_dict, dict) and 'value' in cam_node_dict:
+		cam_node_arg = _resolve_node_arg(cam_node_dict['value'])
+		if cam_node_arg is None:
+			raise RuntimeError('Empty value for "' + cam_node_str + '" in "' + yaml_path + '"')
+	elif cam_node_dict is not None and not isinstance(cam_node_dict, dict):
+		raise RuntimeError('Node "' + cam_node_str + '" must map to {value: ...} or nothing, got: ' +
+						   str(cam_node_dict) + ' in "' + yaml_path + '"')
+
+	# Assume SetValue() when an argument is given, otherwise Execute()
+	cam_method_str = 'Execute' if cam_node_arg is None else 'SetValue'
+	return cam_node_str, cam_node_path, cam_method_str, cam_node_arg
+
+
+def _entry_name(cam_node_str, value):
+	""" Strips "PySpin.<node>_" from an enumeration value """
+
+	prefix = 'PySpin.' + cam_node_str + '_'
+	return value[len(prefix):] if isinstance(value, str) and value.startswith(prefix) else value
+
+
+def _resolve_node_arg(cam_node_arg):
+	""" Resolves arguments of the form "PySpin.<attribute>" """
 
-	# Format command argument in case it's a string containing a PySpin attribute
 	if isinstance(cam_node_arg, str):
 		cam_node_arg_split = cam_node_arg.split('.')
 		if cam_node_arg_split[0] == 'PySpin':
-			if len(cam_node_arg_split) == 2:
-				cam_node_arg = getattr(PySpin, cam_node_arg_split[1])
-			else:
+			if len(cam_node_arg_split) != 2:
 				raise RuntimeError('Arguments containing nested PySpin attributes are currently not supported...')
+			if not hasattr(PySpin, cam_node_arg_split[1]):
+				raise RuntimeError('Unknown PySpin attribute: "' + cam_node_arg + '"')
+			return getattr(PySpin, cam_node_arg_split[1])
+	elif not isinstance(cam_node_arg, (bool, int, float)):
+		raise RuntimeError('Unsupported node value: ' + str(cam_node_arg))
+	return cam_node_arg
+
+
+def load_config(yaml_path):
+	""" Loads and compiles a camera yaml file. Compiled configs are cached by
+	 the hash of the file contents, so each file is only parsed once """
+
+	if not os.path.isfile(yaml_path):
+		raise RuntimeError('"' + yaml_path + '" could not be found!')
+
+	with open(yaml_path, 'rb') as file:
+		contents = file.read()
+	digest = hashlib.sha1(contents).hexdigest()
+	key = (os.path.abspath(yaml_path), digest)
+	if key not in _CONFIG_CACHE:
+		_CONFIG_CACHE[key] = CameraConfig(yaml_path, yaml.load(contents, Loader=yaml.SafeLoader), digest)
+	return _CONFIG_CACHE[key]
+
+
+def warm_start(cam, config, user_set='UserSet1', cache_path=USERSET_CACHE, verify=False):
+	""" Configures an initialized camera from a camera user set. If the hash
+	 recorded for the camera's user set matches the config, the user set is
+	 just loaded. Otherwise the config is replayed in full, saved to the user
+	 set (made the power up default) and its hash recorded. With verify the
+	 loaded node values are also checked against the config, falling back to
+	 the full replay on any difference. Returns 'loaded' or 'saved' """
+
+	cam_id = cam.GetUniqueID()
+	record = _read_usersets(cache_path).get(cam_id)
+	if record == {'digest': config.digest, 'user_set': user_set}:
+		cam.UserSetSelector.SetValue(getattr(PySpin, 'UserSetSelector_' + user_set))
+		cam.UserSetLoad.Execute()
+		if not verify or not config.plan(cam)[1]:
+			return 'loaded'
+		print(cam_id + ' - ' + user_set + ' does not match ' + config.yaml_path + ', replaying config')
+
+	config.apply(cam, diff = False)
+	cam.UserSetSelector.SetValue(getattr(PySpin, 'UserSetSelector_' + user_set))
+	cam.UserSetSave.Execute()
+	cam.UserSetDefault.SetValue(getattr(PySpin, 'UserSetDefault_' + user_set))
+
+	_record_userset(cache_path, cam_id, {'digest': config.digest, 'user_set': user_set})
+	return 'saved'
+
+
+def _read_usersets(cache_path):
+	with _USERSET_LOCK:
+		return _load_usersets(cache_path)
+
+
+def _load_usersets(cache_path):
+	if not os.path.isfile(cache_path):
+		return {}
+	with open(cache_path) as file:
+		return json.load(file)
+
+
+def _record_userset(cache_path, cam_id, record):
+	""" Adds one camera's record to the user set cache. The file is read
+	 again under the lock, so records other cameras saved while this one
+	 was replaying its config are kept, and replaced in one step so a
+	 reader never sees it half written """
+
+	with _USERSET_LOCK:
+		records = _load_usersets(cache_path)
+		records[cam_id] = record
+		with open(cache_path + '.tmp', 'w') as file:
+			json.dump(records, file, indent = 1, sort_keys = True)
+		os.replace(cache_path + '.tmp', cache_path)
+
+
+# A sequencer left running (e.g. by an earlier session) locks the nodes it
+# switches, so it is turned off before anything else is configured
+SEQUENCER_OFF = CameraConfig('<sequencer off>', {'init': [
+	{'SequencerMode': {'value': 'PySpin.SequencerMode_Off'}},
+]}, None)
+SEQUENCER_ON = CameraConfig('<sequencer on>', {'init': [
+	{'SequencerMode': {'value': 'PySpin.SequencerMode_On'}},
+]}, None)
+
+
+def setup_cam(cam, yaml_path, verbose=False, timings=None, user_set=None):
+	""" This will setup (initialize + configure) input
+	 camera given a path to a yaml file or a compiled CameraConfig.
+	 If user_set is given the camera is configured through warm_start.
+	 Seconds spent in Init() and configuring are stored in timings if given
+	 - Credit to https://github.com/justinblaber/multi_pyspin/blob/master/multi_pyspin.py"""
+
+	config = yaml_path if isinstance(yaml_path, CameraConfig) else load_config(yaml_path)
+	timings = {} if timings is None else timings
+
+	# Print setup
+	print(cam.GetUniqueID() + ' - setting up...')
+
+	# Init camera
+	start = time.perf_counter()
+	cam.Init()
+	timings['init'] = time.perf_counter() - start
+	SEQUENCER_OFF.apply(cam)
+
+	if user_set is not None:
+		start = time.perf_counter()
+		result = warm_start(cam, config, user_set)
+		timings['configure'] = time.perf_counter() - start
+		print(cam.GetUniqueID() + ' - ' + config.yaml_path + ': ' + user_set + ' ' + result)
+		return config
 
-	# Perform command
-	if cam_node_arg is None:
-		return getattr(cam_node, cam_method_str)()
-	else:
-		return getattr(cam_node, cam_method_str)(cam_node_arg)
\ No newline at end of file
+	# Perform node commands, skipping the ones already in effect
+	start = time.perf_counter()
+	changes = config.apply(cam, verbose)
+	timings['configure'] = time.perf_counter() - start
+	print(cam.GetUniqueID() + ' - ' + config.yaml_path + ': ' + str(len(changes)) + ' node(s) changed' +
+		  ''.join('\n    ' + node + ': ' + str(old) + ' -> ' + str(new) for node, old, new in changes))
+	return config